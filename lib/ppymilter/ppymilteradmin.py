@@ -0,0 +1,254 @@
+# $Id$
+# ==============================================================================
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+#
+# Local admin socket for the milter servers.
+#
+# Serves a line-based text protocol on a UNIX domain socket from its own
+# threads, so it keeps answering even while a handler blocks the
+# AsyncPpyMilterServer's event loop.  Commands:
+#   connections            List open milter connections: peer, current
+#                          command and SMTP stage, time in stage, time in
+#                          the handler and bytes received but not dispatched.
+#   stacks [SECONDS]       Dump the Python stacks of handlers that have been
+#                          running for at least SECONDS (default 1).
+#   trace on|off           Log every milter packet (sets the 'ppymilter'
+#                          logger to DEBUG), or restore the previous level.
+#   profile start [INTERVAL] | stop | status
+#                          Control a ppymilterprofile.SamplingProfiler; stop
+#                          returns the collapsed stacks sampled.
+#   help                   List the commands.
+#
+# Example usage:
+#"""
+#   import ppymilteradmin
+#   import ppymilterserver
+#
+#   server = ppymilterserver.ThreadedPpyMilterServer(port, MyHandler)
+#   ppymilteradmin.AdminServer('/var/run/mymilter.admin', server).Start()
+#   server.loop()
+#
+#   $ echo 'stacks 5' | socat - UNIX-CONNECT:/var/run/mymilter.admin
+#"""
+#
+
+import errno
+import logging
+import os
+import socket
+import SocketServer
+import stat
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import ppymilterbase
+import ppymilterprofile
+
+logger = logging.getLogger('ppymilter')
+
+
+def _Peer(addr):
+  """Format a connection's peer address."""
+  if isinstance(addr, tuple):
+    return '%s:%s' % addr[:2]
+  return addr or '-'
+
+
+class AdminServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Admin socket for an AsyncPpyMilterServer or ThreadedPpyMilterServer."""
+
+  daemon_threads = True
+
+  def __init__(self, path, milter_server, profiler=None):
+    """Constructs an AdminServer.
+
+    Args:
+      path: The path of the UNIX domain socket to listen on.  A stale socket
+            left there (e.g. by a predecessor process) is replaced.  The
+            socket is only accessible to its owner (it is bound in a
+            temporary directory next to path and then moved there).
+      milter_server: The AsyncPpyMilterServer or ThreadedPpyMilterServer to
+                     administer.
+      profiler: The ppymilterprofile.SamplingProfiler to control; by default
+                a new one.
+    """
+    self.milter_server = milter_server
+    if profiler is None:
+      profiler = ppymilterprofile.SamplingProfiler()
+    self.profiler = profiler
+    self.__saved_level = None
+    SocketServer.UnixStreamServer.__init__(self, path,
+                                           AdminServer.ConnectionHandler)
+
+  def server_bind(self):
+    # Bind in a private (0700) directory and move the socket into place once
+    # it is only accessible to its owner: chmod()ing it at its final path
+    # would leave a window in which other users can connect, and the umask
+    # is shared with the rest of the process.  The rename replaces a stale
+    # socket atomically, e.g. the live one of a predecessor process.
+    path = self.server_address
+    if os.path.lexists(path) and not stat.S_ISSOCK(os.lstat(path).st_mode):
+      raise socket.error(errno.EADDRINUSE, 'not a socket: %s' % path)
+    directory = tempfile.mkdtemp(prefix='.ppymilteradmin',
+                                 dir=os.path.dirname(path) or '.')
+    private_path = os.path.join(directory, 'admin')
+    try:
+      self.socket.bind(private_path)
+      os.chmod(private_path, 0600)
+      os.rename(private_path, path)
+    finally:
+      if os.path.lexists(private_path):
+        os.unlink(private_path)
+      os.rmdir(directory)
+    st = os.stat(path)
+    self.__socket_id = (st.st_dev, st.st_ino)
+
+  def Start(self):
+    """Serve requests in a background thread."""
+    thread = threading.Thread(target=self.serve_forever,
+                              name='ppymilteradmin')
+    thread.setDaemon(True)
+    thread.start()
+
+  def Stop(self):
+    """Stop serving and remove the socket, unless it has been replaced by
+    another server's (e.g. a successor's, see
+    ppymilterserver.AsyncPpyMilterServer.HandOff())."""
+    self.shutdown()
+    self.server_close()
+    try:
+      st = os.stat(self.server_address)
+    except OSError:
+      return
+    if (st.st_dev, st.st_ino) == self.__socket_id:
+      os.unlink(self.server_address)
+
+  def Execute(self, line):
+    """Execute an admin command.
+
+    Args:
+      line: The command and its arguments, separated by whitespace.
+
+    Returns:
+      The (newline terminated) output of the command.
+    """
+    args = line.split()
+    if not args:
+      return ''
+    method = getattr(self, '_Command%s' % args[0].capitalize(), None)
+    if method is None:
+      return 'error: unknown command %r (try "help")\n' % args[0]
+    try:
+      return method(*args[1:])
+    except (TypeError, ValueError), e:
+      return 'error: %s\n' % e
+
+  def _CommandHelp(self):
+    return ('connections\n'
+            'stacks [SECONDS]\n'
+            'trace on|off\n'
+            'profile start [INTERVAL] | stop | status\n'
+            'help\n')
+
+  def _CommandConnections(self):
+    now = time.time()
+    rows = []
+    for handler in self.milter_server.Connections():
+      state = handler.state
+      handler_since = state.handler_since
+      if handler_since is None:
+        in_handler = '-'
+      else:
+        in_handler = '%.3fs' % (now - handler_since)
+      rows.append((state.stage_since, _Peer(state.peer),
+                   ppymilterbase.COMMANDS.get(state.command, '-'),
+                   state.stage or '-', '%.3fs' % (now - state.stage_since),
+                   in_handler, handler.Buffered()))
+    rows.sort()
+    output = ['%-24s %-10s %-14s %10s %10s %8s\n' %
+              ('PEER', 'COMMAND', 'STAGE', 'IN STAGE', 'IN HANDLER',
+               'BUFFERED')]
+    for row in rows:
+      output.append('%-24s %-10s %-14s %10s %10s %8d\n' % row[1:])
+    output.append('%d connection(s)\n' % len(rows))
+    return ''.join(output)
+
+  def _CommandStacks(self, threshold='1'):
+    threshold = float(threshold)
+    now = time.time()
+    frames = sys._current_frames()
+    output = []
+    for handler in self.milter_server.Connections():
+      state = handler.state
+      handler_since = state.handler_since
+      if handler_since is None or now - handler_since < threshold:
+        continue
+      frame = frames.get(state.thread)
+      output.append('%s: %s handler running for %.3fs in thread %s\n' %
+                    (_Peer(state.peer),
+                     ppymilterbase.COMMANDS.get(state.command, '-'),
+                     now - handler_since, state.thread))
+      if frame is not None:
+        output.extend(traceback.format_stack(frame))
+    frames = frame = None  # Do not keep the threads' frames alive.
+    if not output:
+      return 'no handler running for %ss or longer\n' % threshold
+    return ''.join(output)
+
+  def _CommandTrace(self, setting):
+    milter_logger = logging.getLogger('ppymilter')
+    if setting == 'on':
+      if self.__saved_level is None:
+        self.__saved_level = milter_logger.level
+      milter_logger.setLevel(logging.DEBUG)
+    elif setting == 'off':
+      if self.__saved_level is not None:
+        milter_logger.setLevel(self.__saved_level)
+        self.__saved_level = None
+    else:
+      raise ValueError('expected "on" or "off"')
+    logger.info('Tracing turned %s via admin socket', setting)
+    return 'trace %s\n' % setting
+
+  def _CommandProfile(self, action='status', interval=None):
+    profiler = self.profiler
+    if action == 'start':
+      if interval is not None:
+        profiler.interval = float(interval)
+      profiler.Start()
+      return 'profiler started (interval %ss)\n' % profiler.interval
+    if action == 'stop':
+      profiler.Stop()
+      output = StringIO.StringIO()
+      profiler.Write(output)
+      profiler.Clear()
+      return output.getvalue()
+    if action == 'status':
+      if profiler.IsRunning():
+        return 'profiler running (interval %ss)\n' % profiler.interval
+      return 'profiler stopped\n'
+    raise ValueError('expected "start", "stop" or "status"')
+
+  class ConnectionHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+      for line in self.rfile:
+        self.wfile.write(self.server.Execute(line))
+        self.wfile.flush()
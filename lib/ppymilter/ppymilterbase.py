@@ -31,12 +31,21 @@ import os
 import socket
 import struct
 import sys
+import threading
+import time
 import types
 
 logger = logging.getLogger('ppymilter')
 
 
 MILTER_VERSION = 2 # Milter version we claim to speak (from pmilter)
+MILTER_VERSION_6 = 6 # Milter version required for the v6 protocol flags below
+MILTER_CHUNK_SIZE = 65535 # Maximum body chunk size (from libmilter)
+
+# Precompiled structures of binary milter protocol data.
+_OPTNEG = struct.Struct('!III')  # version, actions, protocol
+_CONNECT = struct.Struct('!cH')  # family, port
+_UINT32 = struct.Struct('!I')    # lengths, header indexes
 
 # Potential milter command codes and their corresponding PpyMilter callbacks.
 # From sendmail's include/libmilter/mfdef.h
@@ -72,6 +81,24 @@ COMMANDS = {
   SMFIC_UNKNOWN: 'Unknown',
 }
 
+# SMTP stage during which the MTA sends each milter command.
+STAGES = {
+  SMFIC_OPTNEG:  'negotiate',
+  SMFIC_MACRO:   'negotiate',
+  SMFIC_CONNECT: 'connect',
+  SMFIC_HELO:    'helo',
+  SMFIC_MAIL:    'envelope',
+  SMFIC_RCPT:    'envelope',
+  SMFIC_DATA:    'data',
+  SMFIC_UNKNOWN: 'unknown',
+  SMFIC_HEADER:  'headers',
+  SMFIC_EOH:     'headers',
+  SMFIC_BODY:    'body',
+  SMFIC_BODYEOB: 'end-of-message',
+  SMFIC_ABORT:   'abort',
+  SMFIC_QUIT:    'quit',
+}
+
 # To register/mask callbacks during milter protocol negotiation with sendmail.
 # From sendmail's include/libmilter/mfdef.h
 NO_CALLBACKS = 127  # (all seven callback flags set: 1111111)
@@ -86,6 +113,46 @@ CALLBACKS = {
   'OnBody':       0x00000010L,  # SMFIP_NOBODY    # Skip SMFIC_BODY
 }
 
+# Callbacks whose commands an MTA speaking milter protocol version 6 sends
+# unless they are skipped explicitly (not sent at all in version 2).
+V6_CALLBACKS = {
+  'OnUnknown':    0x00000100L,  # SMFIP_NOUNKNOWN # Skip SMFIC_UNKNOWN
+  'OnData':       0x00000200L,  # SMFIP_NODATA    # Skip SMFIC_DATA
+}
+
+# To negotiate that the MTA will not wait for a reply to a command (milter
+# protocol version 6 only).  The milter must not send one in that case.
+# From sendmail's include/libmilter/mfdef.h
+NO_REPLY = {
+  SMFIC_CONNECT: 0x00001000L,  # SMFIP_NR_CONN
+  SMFIC_HELO:    0x00002000L,  # SMFIP_NR_HELO
+  SMFIC_MAIL:    0x00004000L,  # SMFIP_NR_MAIL
+  SMFIC_RCPT:    0x00008000L,  # SMFIP_NR_RCPT
+  SMFIC_DATA:    0x00010000L,  # SMFIP_NR_DATA
+  SMFIC_UNKNOWN: 0x00020000L,  # SMFIP_NR_UNKN
+  SMFIC_EOH:     0x00040000L,  # SMFIP_NR_EOH
+  SMFIC_BODY:    0x00080000L,  # SMFIP_NR_BODY
+  SMFIC_HEADER:  0x00000080L,  # SMFIP_NR_HDR
+}
+
+# Larger maximum amounts of data per command (e.g. per body chunk) that the
+# milter may request instead of MILTER_CHUNK_SIZE (milter protocol version 6
+# only, see PpyMilter.RequestMaxDataSize()).
+# From sendmail's include/libmilter/mfdef.h
+MILTER_MDS_256K = 262143  # (256 * 1024) - 1
+MILTER_MDS_1M = 1048575   # (1024 * 1024) - 1
+MAX_DATA_SIZES = {
+  MILTER_MDS_256K: 0x10000000L,  # SMFIP_MDS_256K
+  MILTER_MDS_1M:   0x20000000L,  # SMFIP_MDS_1M
+}
+_MAX_DATA_SIZE_FLAGS = (MAX_DATA_SIZES[MILTER_MDS_256K] |
+                        MAX_DATA_SIZES[MILTER_MDS_1M])
+
+# Commands whose data is recorded into a milter's PpyMilterMessage model
+# (see PpyMilter.TrackMessage()).
+MESSAGE_COMMANDS = frozenset([SMFIC_MAIL, SMFIC_RCPT, SMFIC_HEADER,
+                              SMFIC_BODY])
+
 # Acceptable response commands/codes to return to sendmail (with accompanying
 # command data).  From sendmail's include/libmilter/mfdef.h
 RESPONSE = {
@@ -114,6 +181,34 @@ def printchar(char):
           binascii.b2a_base64(char)))
 
 
+def MaxDataSize(protocol):
+  """Return the maximum data size per command selected by protocol flags.
+
+  Args:
+    protocol: Bitmask of negotiated protocol flags.
+
+  Returns:
+    The largest size whose SMFIP_MDS_* flag is set, or MILTER_CHUNK_SIZE.
+  """
+  size = MILTER_CHUNK_SIZE
+  for (mds, flag) in MAX_DATA_SIZES.iteritems():
+    if protocol & flag:
+      size = max(size, mds)
+  return size
+
+
+def _MessageModel(milter):
+  """Return a milter's PpyMilterMessage model (see PpyMilter.Message()), or
+  None if it does not keep one.
+
+  The model is read through PpyMilter.Message itself, not through the
+  instance, since milters may define a Message attribute of their own.
+  """
+  if not isinstance(milter, PpyMilter):
+    return None
+  return PpyMilter.Message(milter)
+
+
 def CanonicalizeAddress(addr):
   """Strip angle brackes from email address iff not an empty address ("<>").
 
@@ -128,6 +223,43 @@ def CanonicalizeAddress(addr):
   return addr.lstrip('<').rstrip('>')
 
 
+class PpyMilterEsmtpArgs(list):
+  """The ESMTP arguments of a MAIL or RCPT command.
+
+  A list of strings, as the 'MailFrom' and 'RcptTo' parsers have always
+  returned (e.g. ['SIZE=1024', 'BODY=8BITMIME', '']), which additionally
+  provides the arguments as keyword/value pairs via Get() and Params().
+  """
+
+  def __init__(self, data, offset=0):
+    """Construct a PpyMilterEsmtpArgs.
+
+    Args:
+      data: Command-specific milter data holding the NUL separated arguments.
+      offset: Index into data at which the arguments start.
+    """
+    list.__init__(self, data[offset:].split('\0'))
+
+  def Params(self):
+    """Return the arguments as a dict mapping upper-cased keywords to values
+    (None for arguments without a value)."""
+    params = {}
+    for arg in self:
+      if arg:
+        (keyword, sep, value) = arg.partition('=')
+        params[keyword.upper()] = value if sep else None
+    return params
+
+  def Get(self, keyword, default=None):
+    """Return the value of an argument (e.g. Get('SIZE')), or default."""
+    keyword = keyword.upper()
+    for arg in self:
+      (name, sep, value) = arg.partition('=')
+      if name.upper() == keyword:
+        return value if sep else None
+    return default
+
+
 class PpyMilterException(Exception):
   """Parent of all other PpyMilter exceptions.  Subclass this: do not
   construct or catch explicitly!"""
@@ -148,6 +280,292 @@ class PpyMilterActionError(PpyMilterException):
   """Exception raised when an action is performed that was not negotiated."""
 
 
+class PpyMilterMessage(object):
+  """Envelope and header model of the message currently being filtered.
+
+  Milters that call PpyMilter.TrackMessage() during their __init__() get an
+  instance of this class from self.Message(), which the PpyMilterDispatcher
+  fills in before invoking the OnMailFrom/OnRcptTo/OnHeader callbacks.
+  Headers are kept in arrival order together with a case-insensitive index by
+  name, so the per-name occurrence number expected by PpyMilter.ChangeHeader()
+  is available without rescanning the header list.
+
+  If constructed with track_body=True the body chunks are collected as well
+  and can be retrieved in one piece using Body().
+
+  The model is cleared when a new MAIL command starts the next message and
+  when the MTA aborts the current one (see PpyMilter.OnAbort()).
+  """
+
+  __slots__ = ('sender', 'sender_esmtp', 'recipients', 'recipients_esmtp',
+               'headers', 'track_body', '__index', '__body')
+
+  def __init__(self, track_body=False):
+    self.track_body = track_body
+    self.Reset()
+
+  def Reset(self):
+    """Clear out all data pertaining to the current message."""
+    self.sender = None
+    self.sender_esmtp = None
+    self.recipients = []
+    self.recipients_esmtp = []
+    self.headers = []
+    self.__index = {}
+    self.__body = []
+
+  def Record(self, cmd, args):
+    """Update the model from a parsed milter command.
+
+    Args:
+      cmd: A single character command code (one of MESSAGE_COMMANDS).
+      args: The arguments returned by the command's parser.
+    """
+    if cmd == SMFIC_HEADER:
+      self.RecordHeader(args[1], args[2])
+    elif cmd == SMFIC_BODY:
+      self.RecordBody(args[1])
+    elif cmd == SMFIC_RCPT:
+      self.RecordRecipient(args[1], args[2])
+    elif cmd == SMFIC_MAIL:
+      self.RecordSender(args[1], args[2])
+
+  def RecordSender(self, mailfrom, esmtp_info):
+    """Start a new message from the given envelope sender.
+
+    Args:
+      mailfrom: The canonicalized MAIL From email address.
+      esmtp_info: Extended SMTP (esmtp) info as a list of strings.
+    """
+    self.Reset()
+    self.sender = mailfrom
+    self.sender_esmtp = esmtp_info
+
+  def RecordRecipient(self, rcptto, esmtp_info):
+    """Add an envelope recipient to the current message.
+
+    Args:
+      rcptto: The canonicalized RCPT To email address.
+      esmtp_info: Extended SMTP (esmtp) info as a list of strings.
+    """
+    self.recipients.append(rcptto)
+    self.recipients_esmtp.append(esmtp_info)
+
+  def RecordHeader(self, key, val):
+    """Append a header to the current message.
+
+    Args:
+      key: The name of the header.
+      val: The value/data for the header.
+
+    Returns:
+      The occurrence number of this header among headers of the same name,
+      offset from 1 (suitable as the index argument to ChangeHeader()).
+    """
+    positions = self.__index.setdefault(key.lower(), [])
+    positions.append(len(self.headers))
+    self.headers.append((key, val))
+    return len(positions)
+
+  def RecordBody(self, chunk):
+    """Append a body chunk to the current message if bodies are tracked."""
+    if self.track_body:
+      self.__body.append(chunk)
+
+  def Body(self):
+    """Return the body of the current message collected so far."""
+    return ''.join(self.__body)
+
+  def HeaderCount(self, name):
+    """Return the number of headers with the given (case-insensitive) name."""
+    return len(self.__index.get(name.lower(), ()))
+
+  def GetHeader(self, name, default=None):
+    """Return the value of the first header with the given name.
+
+    Args:
+      name: The (case-insensitive) name of the header.
+      default: The value to return if there is no such header.
+    """
+    positions = self.__index.get(name.lower())
+    if not positions:
+      return default
+    return self.headers[positions[0]][1]
+
+  def GetHeaders(self, name):
+    """Return the values of all headers with the given name, in order."""
+    headers = self.headers
+    return [headers[i][1] for i in self.__index.get(name.lower(), ())]
+
+  def IterHeaders(self, name):
+    """Iterate over the headers with the given name.
+
+    Yields:
+      (index, value) tuples where index is the occurrence number of the header
+      offset from 1, as expected by PpyMilter.ChangeHeader().
+    """
+    headers = self.headers
+    for (index, i) in enumerate(self.__index.get(name.lower(), ())):
+      yield (index + 1, headers[i][1])
+
+
+class PpyMilterBodyReplacement(object):
+  """A new message body to be sent to the MTA as a series of SMFIR_REPLBODY
+  replies (see PpyMilter.ReplaceBody()).
+
+  The body is read lazily, one chunk per reply, as the server writes the
+  replies to the socket, so it never has to be held in memory as a whole.
+  Implements the asynchat producer interface: more() returns the next
+  complete (length-prefixed) reply packet, or '' once the body is exhausted.
+  """
+
+  def __init__(self, body, chunk_size=MILTER_CHUNK_SIZE):
+    """Construct a PpyMilterBodyReplacement.
+
+    Args:
+      body: The new body as a string, a file-like object (anything with a
+            read() method, including mmap objects), or an iterable of strings.
+      chunk_size: Maximum amount of body data per reply.
+    """
+    self.__chunks = self.__Chunks(body, chunk_size)
+    self.__empty = True
+
+  @staticmethod
+  def __Chunks(body, chunk_size):
+    """Split body into chunks of at most chunk_size bytes."""
+    if isinstance(body, str):
+      for offset in xrange(0, len(body), chunk_size):
+        yield body[offset:offset + chunk_size]
+    elif hasattr(body, 'read'):
+      chunk = body.read(chunk_size)
+      while chunk:
+        yield chunk
+        chunk = body.read(chunk_size)
+    else:
+      (pieces, size) = ([], 0)
+      for piece in body:
+        pieces.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+          data = ''.join(pieces)
+          full = size - size % chunk_size
+          for offset in xrange(0, full, chunk_size):
+            yield data[offset:offset + chunk_size]
+          (pieces, size) = ([data[full:]], size - full)
+      if size:
+        yield ''.join(pieces)
+
+  def more(self):
+    """Return the next REPLBODY reply packet, or '' if there is none left."""
+    for chunk in self.__chunks:
+      self.__empty = False
+      break
+    else:
+      if not self.__empty:
+        return ''
+      # Replacing the body with an empty one still takes one reply.
+      (chunk, self.__empty) = ('', False)
+    return '%s%s%s' % (_UINT32.pack(len(chunk) + 1), RESPONSE['REPLBODY'],
+                       chunk)
+
+
+def _Poolable(milter_class):
+  """Return whether instances of milter_class can be reset for reuse by a
+  PpyMilterPool.
+
+  PpyMilter.OnResetConnection() only clears the per-message state, so a
+  PpyMilter must override it; a PpyMilterComposite is poolable if all of its
+  members are.
+  """
+  if not hasattr(milter_class, 'OnResetConnection'):
+    return False
+  if issubclass(milter_class, PpyMilterComposite):
+    return all([_Poolable(member) for member in milter_class.MILTER_CLASSES])
+  if issubclass(milter_class, PpyMilter):
+    return (milter_class.OnResetConnection.im_func is not
+            PpyMilter.OnResetConnection.im_func)
+  return True
+
+
+class PpyMilterPool(object):
+  """Bounded pool of reusable milter instances.
+
+  Milters whose __init__() is expensive (loading lists, compiling regexes,
+  opening clients) can be pooled instead of being constructed for every
+  connection: pass a PpyMilterPool to the PpyMilterDispatcher (or a pool_size
+  to the servers).  Instances are created on demand and returned to the pool
+  when their connection is closed, after calling their OnResetConnection()
+  callback to clear all per-connection state.  Only milters that override
+  PpyMilter.OnResetConnection() are reused; instances of other classes, or
+  whose callback raises an exception, are discarded instead.  At most
+  max_idle instances are kept, and instances idle for longer than
+  idle_timeout seconds are discarded.  Thread-safe.
+  """
+
+  def __init__(self, milter_class, context=None, max_idle=16,
+               idle_timeout=300):
+    """Construct a PpyMilterPool.
+
+    Args:
+      milter_class: A class (not an instance) that handles callbacks for
+                    milter commands (e.g. a child of the PpyMilter class).
+      context: Passed to milter_class.__init__ if not None.
+      max_idle: Maximum number of idle instances to keep.
+      idle_timeout: Seconds after which idle instances are discarded.
+    """
+    self.milter_class = milter_class
+    self.context = context
+    self.max_idle = max_idle
+    self.idle_timeout = idle_timeout
+    self.__poolable = _Poolable(milter_class)
+    if not self.__poolable:
+      logger.warn('Not reusing %s instances: it (or a member milter) does not '
+                  'override OnResetConnection().', milter_class.__name__)
+    self.__idle = []  # (release time, milter) tuples, oldest first
+    self.__lock = threading.Lock()
+
+  def __Expire(self, now):
+    """Discard the instances idle for too long (the lock must be held)."""
+    idle = self.__idle
+    expired = 0
+    while expired < len(idle) and now - idle[expired][0] > self.idle_timeout:
+      expired += 1
+    del idle[:expired]
+
+  def Acquire(self):
+    """Return an idle milter instance, or a new one if there is none."""
+    now = time.time()
+    self.__lock.acquire()
+    try:
+      self.__Expire(now)
+      if self.__idle:
+        return self.__idle.pop()[1]
+    finally:
+      self.__lock.release()
+    if self.context is not None:
+      return self.milter_class(self.context)
+    return self.milter_class()
+
+  def Release(self, milter):
+    """Reset a milter instance whose connection was closed and return it to
+    the pool."""
+    if not self.__poolable:
+      return
+    try:
+      milter.OnResetConnection()
+    except Exception:
+      logger.exception('Failed to reset milter, discarding it.')
+      return
+    now = time.time()
+    self.__lock.acquire()
+    try:
+      self.__Expire(now)
+      if len(self.__idle) < self.max_idle:
+        self.__idle.append((now, milter))
+    finally:
+      self.__lock.release()
+
+
 class PpyMilterDispatcher(object):
   """Dispatcher class for a milter server.  This class accepts entire
   milter commands as a string (command character + binary data), parses
@@ -156,22 +574,46 @@ class PpyMilterDispatcher(object):
   per socket connection.  One milter_class instance per PpyMilterDispatcher
   (per socket connection)."""
 
-  def __init__(self, milter_class, on_error = None, context = None):
+  def __init__(self, milter_class, on_error = None, context = None,
+               pool = None):
     """Construct a PpyMilterDispatcher and create a private
     milter_class instance.
 
     Args:
       milter_class: A class (not an instance) that handles callbacks for
                     milter commands (e.g. a child of the PpyMilter class).
+      pool: A PpyMilterPool to take the milter_class instance from instead of
+            constructing one; call Close() to return it once the connection
+            has been closed.
     """
-    if context is not None:
+    self.__pool = pool
+    if pool is not None:
+        self.__milter = pool.Acquire()
+    elif context is not None:
         self.__milter = milter_class(context)
     else:
         self.__milter = milter_class()
     self.__on_error = on_error
+    self.__message = _MessageModel(self.__milter)
+    self.__no_reply = frozenset()
+    self.__max_data_size = MILTER_CHUNK_SIZE
+    self.__handlers = {}
+
 
+  def Close(self):
+    """Release the milter instance once the connection has been closed."""
+    (pool, self.__pool) = (self.__pool, None)
+    if pool is not None:
+      pool.Release(self.__milter)
+
+  def MaxDataSize(self):
+    """Return the negotiated maximum amount of data per milter command.
+
+    Servers should refuse packets longer than this plus the command code.
+    """
+    return self.__max_data_size
 
-  def Dispatch(self, data):
+  def Dispatch(self, data, cmd=None):
     """Callback function for the milter socket server to handle a single
     milter command.  Parses the milter command data, invokes the milter
     handler, and formats a suitable response for the server to send
@@ -179,7 +621,11 @@ class PpyMilterDispatcher(object):
 
     Args:
       data: A (binary) string (consisting of a command code character
-            followed by binary data for that command code).
+            followed by binary data for that command code), or only the
+            binary data if cmd is given.
+      cmd: The command code character, if not included in data.  Servers
+           pass it separately so that large packets (body chunks may be up
+           to 1MB) need not be copied just to split it off.
 
     Returns:
       A binary string to write on the socket and return to sendmail.  The
@@ -190,27 +636,51 @@ class PpyMilterDispatcher(object):
       PpyMilterCloseConnection: Indicating the (milter) connection should
                                 be closed.
     """
-    (cmd, data) = (data[0], data[1:])
+    if cmd is None:
+      (cmd, data) = (data[0], data[1:])
+    response = self.__Dispatch(cmd, data)
+    if cmd in self.__no_reply:
+      # The MTA does not expect a reply to this command.
+      return None
+    return response
+
+  def __Dispatch(self, cmd, data):
+    """Parse a single milter command and invoke the milter handler.
+
+    Args:
+      cmd: A single character command code representing this command.
+      data: Command-specific milter data to be unpacked/parsed.
+
+    Returns:
+      The handler's response (see Dispatch()).
+    """
     try:
-      if cmd not in COMMANDS:
+      handlers = self.__handlers.get(cmd)
+      if handlers is None:
+        handlers = self.__handlers[cmd] = self.__LookupHandlers(cmd)
+      (command, parser, callback, record) = handlers
+
+      if command is None:
         logger.warn('Unknown command code: "%s" ("%s")', cmd, data)
         return RESPONSE['CONTINUE']
-      command = COMMANDS[cmd]
-      parser_callback_name = '_Parse%s' % command
-      handler_callback_name = 'On%s' % command
 
-      if not hasattr(self, parser_callback_name):
+      if parser is None:
         logger.error('No parser implemented for "%s"', command)
         return RESPONSE['CONTINUE']
 
-      if not hasattr(self.__milter, handler_callback_name):
+      if callback is None and not record:
         logger.warn('Unimplemented command: "%s" ("%s")', command, data)
         return RESPONSE['CONTINUE']
 
-      parser = getattr(self, parser_callback_name)
-      callback = getattr(self.__milter, handler_callback_name)
       args = parser(cmd, data)
-      return callback(*args)
+      if record:
+        self.__message.Record(cmd, args)
+      if callback is None:
+        return RESPONSE['CONTINUE']
+      response = callback(*args)
+      if cmd == SMFIC_OPTNEG:
+        self.__RecordProtocol(response)
+      return response
     except PpyMilterTempFailure as e:
       logger.info('Temp Failure: %s', str(e))
       return RESPONSE['TEMPFAIL']
@@ -226,6 +696,43 @@ class PpyMilterDispatcher(object):
         raise
     return RESPONSE['CONTINUE']
 
+  def __LookupHandlers(self, cmd):
+    """Look up how to handle a milter command.
+
+    Args:
+      cmd: A single character command code.
+
+    Returns:
+      A tuple (command, parser, callback, record) where:
+        command: The name of the command, or None if it is unknown.
+        parser: The bound parser method, or None.
+        callback: The bound milter handler method, or None.
+        record: Whether the command is recorded into the milter's
+                PpyMilterMessage model.
+    """
+    command = COMMANDS.get(cmd)
+    if command is None:
+      return (None, None, None, False)
+    return (command,
+            getattr(self, '_Parse%s' % command, None),
+            getattr(self.__milter, 'On%s' % command, None),
+            self.__message is not None and cmd in MESSAGE_COMMANDS)
+
+  def __RecordProtocol(self, response):
+    """Remember the protocol flags negotiated by the milter's OptNeg reply.
+
+    Args:
+      response: The reply to the 'OptNeg' milter command.
+    """
+    try:
+      (ver, actions, protocol) = _OPTNEG.unpack_from(response, 1)
+    except (TypeError, struct.error):
+      logger.error('Malformed option negotiation reply: %r', response)
+      return
+    self.__no_reply = frozenset(
+        [cmd for (cmd, flag) in NO_REPLY.iteritems() if protocol & flag])
+    self.__max_data_size = MaxDataSize(protocol)
+
   def _ParseOptNeg(self, cmd, data):
     """Parse the 'OptNeg' milter data into arguments for the milter handler.
 
@@ -242,7 +749,7 @@ class PpyMilterDispatcher(object):
         protocol: Bitmask of the callback functions we are registering.
 
     """
-    (ver, actions, protocol) = struct.unpack('!III', data)
+    (ver, actions, protocol) = _OPTNEG.unpack(data)
     return (cmd, ver, actions, protocol)
 
   def _ParseMacro(self, cmd, data):
@@ -276,11 +783,9 @@ class PpyMilterDispatcher(object):
         port: The network port if appropriate for the connection.
         address: Remote address of the connection (e.g. IP address).
     """
-    (hostname, data) = data.split('\0', 1)
-    family = struct.unpack('c', data[0])[0]
-    port = struct.unpack('!H', data[1:3])[0]
-    address = data[3:]
-    return (cmd, hostname, family, port, address)
+    index = data.index('\0')
+    (family, port) = _CONNECT.unpack_from(data, index + 1)
+    return (cmd, data[:index], family, port, data[index + 4:])
 
   def _ParseHelo(self, cmd, data):
     """Parse the 'Helo' milter data into arguments for the milter handler.
@@ -307,10 +812,12 @@ class PpyMilterDispatcher(object):
       A tuple (cmd, mailfrom, esmtp_info) where:
         cmd: The single character command code representing this command.
         mailfrom: The canonicalized MAIL From email address.
-        esmtp_info: Extended SMTP (esmtp) info as a list of strings.
+        esmtp_info: Extended SMTP (esmtp) info as a list of strings
+                    (a PpyMilterEsmtpArgs).
     """
-    (mailfrom, esmtp_info) = data.split('\0', 1)
-    return (cmd, CanonicalizeAddress(mailfrom), esmtp_info.split('\0'))
+    index = data.index('\0')
+    return (cmd, CanonicalizeAddress(data[:index]),
+            PpyMilterEsmtpArgs(data, index + 1))
 
   def _ParseRcptTo(self, cmd, data):
     """Parse the 'RcptTo' milter data into arguments for the milter handler.
@@ -323,10 +830,39 @@ class PpyMilterDispatcher(object):
       A tuple (cmd, rcptto, emstp_info) where:
         cmd: The single character command code representing this command.
         rcptto: The canonicalized RCPT To email address.
-        esmtp_info: Extended SMTP (esmtp) info as a list of strings.
+        esmtp_info: Extended SMTP (esmtp) info as a list of strings
+                    (a PpyMilterEsmtpArgs).
     """
-    (rcptto, esmtp_info) = data.split('\0', 1)
-    return (cmd, CanonicalizeAddress(rcptto), esmtp_info.split('\0'))
+    index = data.index('\0')
+    return (cmd, CanonicalizeAddress(data[:index]),
+            PpyMilterEsmtpArgs(data, index + 1))
+
+  def _ParseData(self, cmd, data):
+    """Parse the 'Data' milter data into arguments for the milter handler.
+
+    Args:
+      cmd: A single character command code representing this command.
+      data: No data is sent for this command.
+
+    Returns:
+      A tuple (cmd) where:
+        cmd: The single character command code representing this command.
+    """
+    return (cmd)
+
+  def _ParseUnknown(self, cmd, data):
+    """Parse the 'Unknown' milter data into arguments for the milter handler.
+
+    Args:
+      cmd: A single character command code representing this command.
+      data: Command-specific milter data to be unpacked/parsed.
+
+    Returns:
+      A tuple (cmd, command) where:
+        cmd: The single character command code representing this command.
+        command: The unrecognized SMTP command line.
+    """
+    return (cmd, data.rstrip('\0'))
 
   def _ParseHeader(self, cmd, data):
     """Parse the 'Header' milter data into arguments for the milter handler.
@@ -341,9 +877,8 @@ class PpyMilterDispatcher(object):
         key: The name of the header.
         val: The value/data for the header.
     """
-    (key, val) = data.split('\0', 1)
-    val, _ = val.split('\0', 1)
-    return (cmd, key, val)
+    index = data.index('\0')
+    return (cmd, data[:index], data[index + 1:data.index('\0', index + 1)])
 
   def _ParseEndHeaders(self, cmd, data):
     """Parse the 'EndHeaders' milter data into arguments for the milter handler.
@@ -422,6 +957,17 @@ class PpyMilter(object):
   Pass a reference to your handler class to a python milter socket server
   (e.g. AsyncPpyMilterServer) to create a stand-alone milter
   process than invokes your custom handler.
+
+  Milters that only decide once the whole message has been received may
+  instead implement a single OnMessage(envelope, headers, body) callback,
+  where envelope is a (mailfrom, [rcptto, ...]) tuple, headers is a list of
+  (key, val) tuples in arrival order and body is the message body.  The
+  envelope, headers and body are then collected by the dispatcher without
+  invoking any per-command callbacks, the MTA is told not to wait for replies
+  to those commands and to send the body in chunks of up to 1MB if it supports
+  milter protocol version 6, and OnMessage() is called once at the end of the
+  message.  It returns the verdict just like
+  OnEndBody() does, e.g. using ReturnOnEndBodyActions().
   """
 
   # Actions we tell sendmail we may perform
@@ -445,6 +991,15 @@ class PpyMilter(object):
     for (callback, flag) in CALLBACKS.iteritems():
       if hasattr(self, callback):
         self.__protocol &= ~flag
+    self.__message = None
+    if hasattr(self, 'OnMessage'):
+      self.TrackMessage(track_body=True)
+      for cmd in (SMFIC_MAIL, SMFIC_RCPT, SMFIC_HEADER, SMFIC_BODY):
+        if not hasattr(self, 'On%s' % COMMANDS[cmd]):
+          self.__protocol |= NO_REPLY[cmd]
+      if not hasattr(self, 'OnBody'):
+        # The body is only collected, so take it in as few chunks as possible.
+        self.RequestMaxDataSize(MILTER_MDS_1M)
 
   def Accept(self):
     """Create an 'ACCEPT' response to return to the milter dispatcher."""
@@ -516,7 +1071,7 @@ class PpyMilter(object):
       value: The value to insert.
     """
     self.__VerifyCapability(self.ACTION_ADDHDRS)
-    index = struct.pack('!I', index)
+    index = _UINT32.pack(index)
     return '%s%s%s\0%s\0' % (RESPONSE['INSHEADER'], index, name, value)
 
   def ChangeHeader(self, index, name, value):
@@ -530,9 +1085,24 @@ class PpyMilter(object):
       value: The value to insert.
     """
     self.__VerifyCapability(self.ACTION_CHGHDRS)
-    index = struct.pack('!I', index)
+    index = _UINT32.pack(index)
     return '%s%s%s\0%s\0' % (RESPONSE['CHGHEADER'], index, name, value)
 
+  def ReplaceBody(self, body):
+    """Construct a series of REPLBODY replies that the client can send during
+    OnEndBody.
+
+    The servers stream the new body to the MTA chunk by chunk, so large bodies
+    can be passed as a file object, mmap or generator rather than a string.
+
+    Args:
+      body: The new body as a string, a file-like object (anything with a
+            read() method, including mmap objects), or an iterable of strings.
+            Lines must be terminated by CRLF.
+    """
+    self.__VerifyCapability(self.ACTION_CHGBODY)
+    return PpyMilterBodyReplacement(body)
+
   def ReturnOnEndBodyActions(self, actions):
     """Construct an OnEndBody response that can consist of multiple actions
     followed by a final required Continue().
@@ -576,11 +1146,27 @@ class PpyMilter(object):
     processing of the next message. This method also implements an
     'OnResetState' callback that milters can use to catch this situation too.
     """
+    if self.__message is not None:
+      self.__message.Reset()
     try:
       self.OnResetState()
     except AttributeError:
       logger.warn('No OnResetState() callback is defined for this milter.')
 
+  def OnResetConnection(self):
+    """Callback invoked when the milter instance is returned to a
+    PpyMilterPool after its connection was closed.
+
+    Override it (and call PpyMilter.OnResetConnection(self)) to clear any
+    per-connection state your milter keeps, such as data from OnConnect() or
+    OnHelo().  The default implementation clears the per-message state;
+    PpyMilterPool only reuses instances of milters that override it.
+    """
+    if self.__message is not None:
+      self.__message.Reset()
+    if hasattr(self, 'OnResetState'):
+      self.OnResetState()
+
   # you probably should not be overriding this  :-p
   def OnOptNeg(self, cmd, ver, actions, protocol):
     """Callback for the 'OptNeg' (option negotiation) milter command.
@@ -592,9 +1178,20 @@ class PpyMilter(object):
     (2) Stated actions your milter may perform by invoking the
         "self.CanFoo()" functions during your milter's __init__().
     """
-    out = struct.pack('!III', MILTER_VERSION,
-                      self.__actions & actions,
-                      self.__protocol & protocol)
+    offered = protocol
+    protocol &= self.__protocol
+    # Of the data sizes we requested that the MTA offers, pick the largest.
+    protocol = ((protocol & ~_MAX_DATA_SIZE_FLAGS) |
+                MAX_DATA_SIZES.get(MaxDataSize(protocol), 0))
+    version = MILTER_VERSION
+    if protocol & ~NO_CALLBACKS:
+      # Requesting version 6 protocol flags, so speak version 6, which also
+      # means we have to opt out of commands that did not exist in version 2.
+      version = min(ver, MILTER_VERSION_6)
+      for (callback, flag) in V6_CALLBACKS.iteritems():
+        if not hasattr(self, callback):
+          protocol |= flag & offered
+    out = _OPTNEG.pack(version, self.__actions & actions, protocol)
     return cmd+out
 
   def OnMacro(self, cmd, macro_cmd, data):
@@ -642,6 +1239,10 @@ class PpyMilter(object):
       A continue response so that further messages in this SMTP conversation
       will be processed.
     """
+    if hasattr(self, 'OnMessage'):
+      message = self.__message
+      return self.OnMessage((message.sender, message.recipients),
+                            message.headers, message.Body())
     return self.Continue()
 
   # Call these from __init__() (after calling PpyMilter.__init__()  :-p
@@ -671,8 +1272,263 @@ class PpyMilter(object):
     """Register that our milter may perform the action 'QUARANTINE'."""
     self.__actions |= self.ACTION_QUARANTINE
 
+  def TrackMessage(self, track_body=False):
+    """Maintain a PpyMilterMessage model of the current message, available
+    from self.Message().
+
+    The envelope sender, recipients and headers are recorded by the
+    dispatcher whether or not your milter implements the OnMailFrom,
+    OnRcptTo and OnHeader callbacks, so e.g. a milter that only implements
+    OnEndBody can still consult self.Message() there:
+    +---------------------------------------------------------------------
+    | class SubjectTagMilter(PpyMilter):
+    |  def __init__(self):
+    |    PpyMilter.__init__(self)
+    |    self.CanChangeHeaders()
+    |    self.TrackMessage()
+    |  def OnEndBody(self, cmd):
+    |    actions = []
+    |    for (index, subject) in self.Message().IterHeaders('Subject'):
+    |      actions.append(
+    |          self.ChangeHeader(index, 'Subject', '[ext]' + subject))
+    |    return self.ReturnOnEndBodyActions(actions)
+    +---------------------------------------------------------------------
+
+    Args:
+      track_body: Whether to collect the message body as well.
+    """
+    for callback in ('OnMailFrom', 'OnRcptTo', 'OnHeader'):
+      self.__protocol &= ~CALLBACKS[callback]
+    if track_body:
+      self.__protocol &= ~CALLBACKS['OnBody']
+    if self.__message is None:
+      self.__message = PpyMilterMessage(track_body)
+    else:
+      self.__message.track_body |= track_body
+
+  def Message(self):
+    """Return the PpyMilterMessage model of the current message, or None if
+    TrackMessage() has not been called."""
+    return self.__message
+
+  def RequestMaxDataSize(self, size=MILTER_MDS_1M):
+    """Ask the MTA to send body chunks (and other command data) of up to size
+    bytes instead of MILTER_CHUNK_SIZE, which means fewer OnBody() calls for
+    large messages.  If the MTA does not offer that size, the next smaller one
+    it offers is used.  Call this during your milter's __init__().
+
+    Args:
+      size: MILTER_MDS_256K or MILTER_MDS_1M.
+
+    Raises:
+      ValueError: size is not one of the sizes the milter protocol supports.
+    """
+    if size not in MAX_DATA_SIZES:
+      raise ValueError('unsupported maximum data size: %r' % size)
+    for (mds, flag) in MAX_DATA_SIZES.iteritems():
+      if mds <= size:
+        self.__protocol |= flag
+
   def __VerifyCapability(self, action):
     if not (self.__actions & action):
       logger.error('Error: Attempted to perform an action that was not' +
                      'requested.')
       raise PpyMilterActionError('Action not requested in __init__')
+
+
+class PpyMilterComposite(PpyMilter):
+  """Milter that runs several milters on the same milter connection.
+
+  Each milter command is parsed once by the PpyMilterDispatcher and handed to
+  every member milter in turn, so several independent policies can share one
+  milter process (and one round trip from the MTA) instead of the MTA
+  transmitting every message to each of them separately.  Subclass it and
+  list the member milter classes in MILTER_CLASSES:
+  +---------------------------------------------------------------------
+  | class MyMilter(PpyMilterComposite):
+  |   MILTER_CLASSES = (ReputationMilter, HeaderCheckMilter, ContentMilter)
+  |
+  | ppymilterserver.AsyncPpyMilterServer(port, MyMilter)
+  +---------------------------------------------------------------------
+
+  Verdicts are merged as follows:
+    * The first member to reject, tempfail, discard or return a custom reply
+      code wins; later members do not see the command.
+    * A member that accepts is not called again for the rest of the message
+      (or of the connection, if it accepted the connection or HELO).  Once all
+      members have accepted, the composite accepts.
+    * At the end of the message the modification actions of all members are
+      concatenated.
+  Option negotiation requests the union of the members' actions and of the
+  commands (and replies) they need.
+  """
+
+  MILTER_CLASSES = ()
+
+  # Responses which end processing of the current command for all members.
+  __FINAL_RESPONSES = frozenset([
+      RESPONSE['REJECT'], RESPONSE['TEMPFAIL'], RESPONSE['DISCARD'],
+      RESPONSE['REPLYCODE'], RESPONSE['CONNFAIL']])
+
+  def __init__(self, *args):
+    """Construct a PpyMilterComposite and its member milters.
+
+    Args:
+      args: Passed on to each member milter class (e.g. the server context).
+    """
+    PpyMilter.__init__(self)
+    self.__milters = [milter_class(*args)
+                      for milter_class in self.MILTER_CLASSES]
+    self.__connection_active = self.__milters[:]
+    self.__active = self.__milters[:]
+
+  def __Deactivate(self, milter, cmd):
+    """Stop calling a member that accepted during the given command."""
+    self.__active.remove(milter)
+    if cmd in (SMFIC_CONNECT, SMFIC_HELO):
+      self.__connection_active.remove(milter)
+
+  def __StartMessage(self):
+    """Reactivate members that only accepted the previous message."""
+    self.__active = self.__connection_active[:]
+
+  def __FanOut(self, cmd, args):
+    """Invoke the handler for a milter command on all active members.
+
+    Args:
+      cmd: A single character command code representing this command.
+      args: The arguments returned by the command's parser.
+
+    Returns:
+      The merged response.
+    """
+    handler_callback_name = 'On%s' % COMMANDS[cmd]
+    for milter in self.__active[:]:
+      if cmd in MESSAGE_COMMANDS:
+        message = _MessageModel(milter)
+        if message is not None:
+          message.Record(cmd, args)
+      callback = getattr(milter, handler_callback_name, None)
+      if callback is None:
+        continue
+      response = callback(*args)
+      if not response or response == RESPONSE['CONTINUE']:
+        continue
+      if response == RESPONSE['ACCEPT']:
+        self.__Deactivate(milter, cmd)
+      elif response[0] in self.__FINAL_RESPONSES:
+        return response
+    if not self.__active:
+      return self.Accept()
+    return self.Continue()
+
+  def OnOptNeg(self, cmd, ver, actions, protocol):
+    """Callback for the 'OptNeg' milter command.
+
+    Negotiates options with each member and requests the union of their
+    actions, plus every command and reply that at least one of them needs.
+    The maximum data size is the smallest one negotiated by the members that
+    receive the message body.
+    """
+    (version, our_actions, our_protocol) = (MILTER_VERSION, 0, protocol)
+    data_size = None
+    for milter in self.__milters:
+      response = milter.OnOptNeg(cmd, ver, actions, protocol)
+      (milter_ver, milter_actions, milter_protocol) = _OPTNEG.unpack_from(
+          response, 1)
+      version = max(version, milter_ver)
+      our_actions |= milter_actions
+      our_protocol &= milter_protocol
+      if not milter_protocol & CALLBACKS['OnBody']:
+        data_size = min(data_size or MILTER_MDS_1M,
+                        MaxDataSize(milter_protocol))
+    our_protocol &= ~_MAX_DATA_SIZE_FLAGS
+    our_protocol |= MAX_DATA_SIZES.get(data_size, 0)
+    if version < MILTER_VERSION_6:
+      our_protocol &= NO_CALLBACKS
+    return cmd + _OPTNEG.pack(version, our_actions, our_protocol)
+
+  def OnConnect(self, *args):
+    return self.__FanOut(SMFIC_CONNECT, args)
+
+  def OnHelo(self, *args):
+    return self.__FanOut(SMFIC_HELO, args)
+
+  def OnMailFrom(self, *args):
+    self.__StartMessage()
+    return self.__FanOut(SMFIC_MAIL, args)
+
+  def OnRcptTo(self, *args):
+    return self.__FanOut(SMFIC_RCPT, args)
+
+  def OnData(self, *args):
+    return self.__FanOut(SMFIC_DATA, args)
+
+  def OnUnknown(self, *args):
+    return self.__FanOut(SMFIC_UNKNOWN, args)
+
+  def OnHeader(self, *args):
+    return self.__FanOut(SMFIC_HEADER, args)
+
+  def OnEndHeaders(self, *args):
+    return self.__FanOut(SMFIC_EOH, args)
+
+  def OnBody(self, *args):
+    return self.__FanOut(SMFIC_BODY, args)
+
+  def OnEndBody(self, cmd):
+    """Callback for the 'EndBody' milter command.
+
+    Collects the modification actions of all active members, unless one of
+    them rejects (or tempfails, discards, ...) the message.
+    """
+    actions = []
+    try:
+      for milter in self.__active:
+        response = milter.OnEndBody(cmd)
+        if isinstance(response, list):
+          (response, milter_actions) = (response[-1], response[:-1])
+          actions.extend(milter_actions)
+        if response and response[0] in self.__FINAL_RESPONSES:
+          return response
+    finally:
+      self.__StartMessage()
+    replacements = [action for action in actions
+                    if isinstance(action, PpyMilterBodyReplacement)]
+    if len(replacements) > 1:
+      logger.warn('Several milters replaced the body, using the last one.')
+      actions = [action for action in actions
+                 if not isinstance(action, PpyMilterBodyReplacement) or
+                    action is replacements[-1]]
+    return self.ReturnOnEndBodyActions(actions)
+
+  def OnMacro(self, cmd, macro_cmd, data):
+    """Callback for the 'Macro' milter command: no response required."""
+    for milter in self.__connection_active:
+      if hasattr(milter, 'OnMacro'):
+        milter.OnMacro(cmd, macro_cmd, data)
+    return None
+
+  def OnResetConnection(self):
+    """Callback invoked when the composite is returned to a PpyMilterPool:
+    reset all members."""
+    for milter in self.__milters:
+      milter.OnResetConnection()
+    self.__connection_active = self.__milters[:]
+    self.__StartMessage()
+
+  def OnAbort(self, cmd):
+    """Callback for the 'Abort' milter command: reset all members."""
+    for milter in self.__milters:
+      milter.OnAbort(cmd)
+    self.__StartMessage()
+    return None
+
+  def OnQuit(self, cmd):
+    """Callback for the 'Quit' milter command: close the milter connection."""
+    for milter in self.__milters:
+      try:
+        milter.OnQuit(cmd)
+      except PpyMilterCloseConnection:
+        pass
+    raise PpyMilterCloseConnection('received quit command')
@@ -0,0 +1,438 @@
+#!/usr/bin/python2.4
+# $Id$
+# ==============================================================================
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+#
+# Memory-mapped lookup indexes for large envelope policy lists (allow/block
+# lists of domains, addresses and IP networks).
+#
+# Indexes are built once into a compact file format and opened with mmap, so
+# opening them is instant regardless of their size and all worker processes
+# share the same (page cache) memory.  Lookups walk the on-disk structure
+# directly without deserializing it:
+#   * DomainIndex: a trie over reversed domain labels.  An entry for a domain
+#     matches the domain itself, all its subdomains and all addresses in them;
+#     an entry for an address ("user@example.com") matches only that address.
+#   * CidrIndex: path-compressed binary radix trees for IPv4 and IPv6 networks,
+#     returning the longest matching prefix.
+# Every entry carries a non-zero integer value (1 by default), e.g. to tell
+# allow entries from block entries, which lookups return.
+#
+# Indexes are written to a temporary file that is then renamed into place, so
+# processes that have an older version open continue to use it undisturbed.
+#
+# Example usage:
+#"""
+#   $ ppymilterlookup.py domains blocked-domains.txt blocked-domains.idx
+#   $ ppymilterlookup.py cidr blocked-networks.txt blocked-networks.idx
+#
+#   import ppymilterbase
+#   import ppymilterlookup
+#
+#   BLOCKED_DOMAINS = ppymilterlookup.DomainIndex('blocked-domains.idx')
+#   BLOCKED_NETWORKS = ppymilterlookup.CidrIndex('blocked-networks.idx')
+#
+#   class BlockListMilter(ppymilterbase.PpyMilter):
+#     def OnConnect(self, cmd, hostname, family, port, address):
+#       if BLOCKED_NETWORKS.Lookup(address):
+#         return self.Reject()
+#       return self.Continue()
+#     def OnMailFrom(self, cmd, mailfrom, esmtp_info):
+#       if BLOCKED_DOMAINS.Lookup(mailfrom):
+#         return self.Reject()
+#       return self.Continue()
+#"""
+#
+
+import mmap
+import optparse
+import os
+import socket
+import struct
+import sys
+
+DOMAIN_MAGIC = 'PMLD'
+CIDR_MAGIC = 'PMLC'
+FORMAT_VERSION = 1
+
+# magic, version, root node offset(s)/labels offset
+_HEADER = struct.Struct('!4sIII')
+# Domain trie node: value, number of children; followed by the children.
+_DOMAIN_NODE = struct.Struct('!II')
+# Domain trie child: label offset (in label table), label length, node offset.
+_DOMAIN_CHILD = struct.Struct('!III')
+# Radix tree node: prefix length, value, child offsets for the next bit being
+# 0 and 1, prefix (high and low 64 bits).
+_CIDR_NODE = struct.Struct('!BxxxIIIQQ')
+
+_MASK64 = (1 << 64) - 1
+
+
+class LookupIndexError(Exception):
+  """Exception raised for malformed index files or entries."""
+
+
+def _DomainLabels(name):
+  """Return the trie path for a domain or address.
+
+  Args:
+    name: A domain name or an email address.
+
+  Returns:
+    The lower-cased domain labels, top-level domain first, followed by
+    '@' + local part for addresses.
+  """
+  name = name.lower()
+  (local, at, domain) = name.rpartition('@')
+  labels = domain.strip('.').split('.')
+  labels.reverse()
+  if at:
+    labels.append('@' + local)
+  return labels
+
+
+def _ParseAddress(address):
+  """Parse an IP address as passed by the MTA.
+
+  Args:
+    address: An IPv4 or IPv6 address, optionally enclosed in brackets or
+             prefixed with 'IPv6:' (as sendmail does) and NUL terminated.
+
+  Returns:
+    A tuple (width, number) of the address width in bits (32 or 128) and the
+    address as an integer.
+
+  Raises:
+    socket.error: The address cannot be parsed.
+  """
+  address = address.rstrip('\0').strip('[]')
+  if address[:5].lower() == 'ipv6:':
+    address = address[5:]
+  if ':' in address:
+    (hi, lo) = struct.unpack('!QQ', socket.inet_pton(socket.AF_INET6, address))
+    return (128, (hi << 64) | lo)
+  return (32, struct.unpack('!I', socket.inet_pton(socket.AF_INET, address))[0])
+
+
+def _WriteAtomically(path, data):
+  """Write data to path via a temporary file renamed into place."""
+  tmp_path = '%s.tmp.%d' % (path, os.getpid())
+  output = open(tmp_path, 'wb')
+  try:
+    output.write(data)
+  finally:
+    output.close()
+  os.rename(tmp_path, path)
+
+
+def _Entries(entries):
+  """Normalize an iterable of keys or (key, value) tuples."""
+  for entry in entries:
+    if isinstance(entry, tuple):
+      (key, value) = entry
+    else:
+      (key, value) = (entry, 1)
+    if not 0 < value <= 0xffffffff:
+      raise LookupIndexError('value out of range for %r: %r' % (key, value))
+    yield (key, value)
+
+
+def BuildDomainIndex(entries, path):
+  """Build a DomainIndex file.
+
+  Args:
+    entries: An iterable of domain names or email addresses, or of (name,
+             value) tuples with a non-zero integer value (1 by default).
+    path: The file to write the index to.
+  """
+  root = [0, {}]
+  for (name, value) in _Entries(entries):
+    node = root
+    for label in _DomainLabels(name):
+      node = node[1].setdefault(label, [0, {}])
+    node[0] = value
+
+  # Lay the nodes out breadth-first, then emit them with child offsets.
+  (nodes, offsets, offset) = ([], {}, _HEADER.size)
+  queue = [root]
+  while queue:
+    next_queue = []
+    for node in queue:
+      offsets[id(node)] = offset
+      offset += _DOMAIN_NODE.size + _DOMAIN_CHILD.size * len(node[1])
+      nodes.append(node)
+      next_queue.extend([node[1][label] for label in sorted(node[1])])
+    queue = next_queue
+  # Each distinct label is stored once in the label table.
+  (chunks, labels, label_table, labels_size) = ([], {}, [], 0)
+  for node in nodes:
+    chunks.append(_DOMAIN_NODE.pack(node[0], len(node[1])))
+    for label in sorted(node[1]):
+      if label not in labels:
+        labels[label] = labels_size
+        labels_size += len(label)
+        label_table.append(label)
+      chunks.append(_DOMAIN_CHILD.pack(labels[label], len(label),
+                                       offsets[id(node[1][label])]))
+  header = _HEADER.pack(DOMAIN_MAGIC, FORMAT_VERSION, offsets[id(root)],
+                        offset)
+  _WriteAtomically(path, header + ''.join(chunks) + ''.join(label_table))
+
+
+def _BuildRadix(items, width, nodes):
+  """Build a path-compressed radix (sub)tree.
+
+  Args:
+    items: Sorted list of (prefix, length, value) tuples sharing a common
+           prefix, with host bits cleared.
+    width: The address width in bits.
+    nodes: List to append the nodes to, as [length, value, child0, child1,
+           prefix] lists with children given as node indexes.
+
+  Returns:
+    The index of the subtree's root node.
+  """
+  (first, last) = (items[0][0], items[-1][0])
+  depth = min(width - (first ^ last).bit_length(),
+              min([length for (prefix, length, value) in items]))
+  mask = ((1 << depth) - 1) << (width - depth)
+  node = [depth, 0, None, None, first & mask]
+  index = len(nodes)
+  nodes.append(node)
+  rest = []
+  for item in items:
+    if item[1] == depth:
+      node[1] = item[2]
+    else:
+      rest.append(item)
+  if rest:
+    bit = 1 << (width - depth - 1)
+    split = 0
+    while split < len(rest) and not rest[split][0] & bit:
+      split += 1
+    if split:
+      node[2] = _BuildRadix(rest[:split], width, nodes)
+    if split < len(rest):
+      node[3] = _BuildRadix(rest[split:], width, nodes)
+  return index
+
+
+def BuildCidrIndex(entries, path):
+  """Build a CidrIndex file.
+
+  Args:
+    entries: An iterable of networks ('192.0.2.0/24', '2001:db8::/32') or
+             addresses, or of (network, value) tuples with a non-zero integer
+             value (1 by default).
+    path: The file to write the index to.
+  """
+  prefixes = {32: {}, 128: {}}
+  for (network, value) in _Entries(entries):
+    (address, slash, length) = network.partition('/')
+    try:
+      (width, number) = _ParseAddress(address)
+    except socket.error:
+      raise LookupIndexError('invalid network: %r' % network)
+    length = int(length) if slash else width
+    if not 0 <= length <= width:
+      raise LookupIndexError('invalid prefix length: %r' % network)
+    number &= ((1 << length) - 1) << (width - length)
+    prefixes[width][(number, length)] = value
+
+  roots = {32: 0, 128: 0}
+  chunks = []
+  offset = _HEADER.size
+  for width in (32, 128):
+    if not prefixes[width]:
+      continue
+    items = [(number, length, value) for ((number, length), value)
+             in sorted(prefixes[width].iteritems())]
+    nodes = []
+    _BuildRadix(items, width, nodes)
+    base = offset
+    roots[width] = base
+    for (depth, value, child0, child1, prefix) in nodes:
+      chunks.append(_CIDR_NODE.pack(
+          depth, value,
+          child0 is not None and base + child0 * _CIDR_NODE.size or 0,
+          child1 is not None and base + child1 * _CIDR_NODE.size or 0,
+          prefix >> 64, prefix & _MASK64))
+    offset += len(nodes) * _CIDR_NODE.size
+  header = _HEADER.pack(CIDR_MAGIC, FORMAT_VERSION, roots[32], roots[128])
+  _WriteAtomically(path, header + ''.join(chunks))
+
+
+class _MappedIndex(object):
+  """Base class of memory-mapped index files."""
+
+  MAGIC = None
+
+  def __init__(self, path):
+    """Open an index file.
+
+    Args:
+      path: The index file.
+
+    Raises:
+      LookupIndexError: The file is not an index of the expected kind.
+    """
+    index_file = open(path, 'rb')
+    try:
+      self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      index_file.close()
+    try:
+      (magic, version, self._root_a, self._root_b) = _HEADER.unpack_from(
+          self._map)
+    except struct.error:
+      magic = version = None
+    if magic != self.MAGIC or version != FORMAT_VERSION:
+      self._map.close()
+      raise LookupIndexError('%s is not a %s file' %
+                             (path, self.__class__.__name__))
+
+  def __contains__(self, key):
+    return self.Lookup(key) is not None
+
+  def Close(self):
+    """Unmap the index file."""
+    self._map.close()
+
+
+class DomainIndex(_MappedIndex):
+  """Memory-mapped index of domains and email addresses (see
+  BuildDomainIndex())."""
+
+  MAGIC = DOMAIN_MAGIC
+
+  def Lookup(self, name):
+    """Look up a domain or email address.
+
+    Args:
+      name: A domain name or (canonicalized) email address.
+
+    Returns:
+      The value of the most specific matching entry, or None.
+    """
+    index_map = self._map
+    labels_offset = self._root_b
+    node = self._root_a
+    best = None
+    for label in _DomainLabels(name):
+      (value, count) = _DOMAIN_NODE.unpack_from(index_map, node)
+      if value:
+        best = value
+      # Binary search of the node's sorted children.
+      (low, high) = (0, count)
+      children = node + _DOMAIN_NODE.size
+      while low < high:
+        middle = (low + high) // 2
+        (start, length, child) = _DOMAIN_CHILD.unpack_from(
+            index_map, children + middle * _DOMAIN_CHILD.size)
+        start += labels_offset
+        candidate = index_map[start:start + length]
+        if candidate < label:
+          low = middle + 1
+        elif candidate > label:
+          high = middle
+        else:
+          break
+      else:
+        return best
+      node = child
+    value = _DOMAIN_NODE.unpack_from(index_map, node)[0]
+    return value or best
+
+
+class CidrIndex(_MappedIndex):
+  """Memory-mapped index of IPv4 and IPv6 networks (see BuildCidrIndex())."""
+
+  MAGIC = CIDR_MAGIC
+
+  def Lookup(self, address):
+    """Look up an IP address.
+
+    Args:
+      address: An IPv4 or IPv6 address as passed to OnConnect() (optionally
+               with brackets, sendmail's 'IPv6:' prefix or a trailing NUL).
+
+    Returns:
+      The value of the longest matching network, or None (also for
+      unparseable addresses).
+    """
+    try:
+      (width, number) = _ParseAddress(address)
+    except socket.error:
+      return None
+    node = self._root_a if width == 32 else self._root_b
+    index_map = self._map
+    best = None
+    while node:
+      (depth, value, child0, child1, hi, lo) = _CIDR_NODE.unpack_from(
+          index_map, node)
+      shift = width - depth
+      if number >> shift != ((hi << 64) | lo) >> shift:
+        break
+      if value:
+        best = value
+      if not shift:
+        break
+      if (number >> (shift - 1)) & 1:
+        node = child1
+      else:
+        node = child0
+    return best
+
+
+def _ReadEntries(input_file):
+  """Parse "key [value]" lines, ignoring blank lines and # comments."""
+  for line in input_file:
+    line = line.split('#', 1)[0].split()
+    if not line:
+      continue
+    if len(line) == 1:
+      yield line[0]
+    else:
+      yield (line[0], int(line[1]))
+
+
+def main(argv):
+  parser = optparse.OptionParser(
+      usage='%prog {domains|cidr} INPUT OUTPUT\n\n'
+            'Build a lookup index from INPUT, which lists one domain or\n'
+            'address (domains) or one IP network (cidr) per line, optionally\n'
+            'followed by a positive integer value.  INPUT may be - for stdin.')
+  (options, args) = parser.parse_args(argv[1:])
+  if len(args) != 3 or args[0] not in ('domains', 'cidr'):
+    parser.error('expected {domains|cidr} INPUT OUTPUT')
+  (kind, input_path, output_path) = args
+  if input_path == '-':
+    input_file = sys.stdin
+  else:
+    input_file = open(input_path)
+  try:
+    if kind == 'domains':
+      BuildDomainIndex(_ReadEntries(input_file), output_path)
+    else:
+      BuildCidrIndex(_ReadEntries(input_file), output_path)
+  except (LookupIndexError, ValueError), e:
+    parser.error(str(e))
+  finally:
+    input_file.close()
+
+
+if __name__ == '__main__':
+  main(sys.argv)
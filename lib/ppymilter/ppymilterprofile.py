@@ -0,0 +1,198 @@
+# $Id$
+# ==============================================================================
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+#
+# On-demand sampling profiler for milter processes.
+#
+# While running, a background thread periodically samples the Python stacks of
+# all threads that are inside PpyMilterDispatcher.Dispatch() and tags each
+# sample with the milter command being handled and the corresponding SMTP
+# stage.  The samples are written in the "collapsed stack" format understood
+# by flame graph tools (e.g. flamegraph.pl).  The dispatcher itself is not
+# instrumented, so the profiler costs nothing while it is stopped.
+#
+# Example usage:
+#"""
+#   import ppymilterprofile
+#
+#   # kill -USR1 <pid> starts profiling, a second kill -USR1 stops it and
+#   # writes the samples to /tmp/milter.folded
+#   profiler = ppymilterprofile.SamplingProfiler()
+#   ppymilterprofile.InstallSignalHandler(profiler, '/tmp/milter.folded')
+#"""
+#
+
+import logging
+import os
+import signal
+import sys
+import threading
+
+import ppymilterbase
+
+logger = logging.getLogger('ppymilter')
+
+# SMTP stage during which the MTA sends each milter command.
+STAGES = ppymilterbase.STAGES
+
+_DISPATCH_CODE = ppymilterbase.PpyMilterDispatcher.Dispatch.im_func.func_code
+
+
+class SamplingProfiler(object):
+  """Statistical profiler attributing samples to milter commands."""
+
+  def __init__(self, interval=0.005):
+    """Constructs a SamplingProfiler.
+
+    Args:
+      interval: Seconds between samples.
+    """
+    self.interval = interval
+    self.__lock = threading.Lock()
+    self.__counts = {}
+    self.__labels = {}
+    self.__stop = None
+    self.__thread = None
+
+  def IsRunning(self):
+    """Return whether the profiler is currently sampling."""
+    return self.__thread is not None
+
+  def Start(self):
+    """Start sampling in a background thread."""
+    if self.__thread is not None:
+      return
+    self.__stop = threading.Event()
+    self.__thread = threading.Thread(target=self.__Run, args=(self.__stop,),
+                                     name='ppymilterprofile')
+    self.__thread.setDaemon(True)
+    self.__thread.start()
+    logger.info('Profiler started (interval %ss)', self.interval)
+
+  def Stop(self):
+    """Stop sampling; the samples collected so far are retained."""
+    if self.__thread is None:
+      return
+    self.__stop.set()
+    if self.__thread is not threading.currentThread():
+      self.__thread.join()
+    self.__thread = None
+    logger.info('Profiler stopped')
+
+  def Clear(self):
+    """Discard all samples collected so far."""
+    self.__lock.acquire()
+    try:
+      self.__counts = {}
+    finally:
+      self.__lock.release()
+
+  def Write(self, output):
+    """Write the samples collected so far in collapsed stack format.
+
+    Each line consists of the semicolon separated stack, outermost frame
+    first, preceded by the SMTP stage and milter command, followed by the
+    number of samples, e.g.:
+      stage:envelope;command:RcptTo;Dispatch (ppymilterbase.py:360);... 42
+
+    Args:
+      output: A file-like object to write to.
+    """
+    self.__lock.acquire()
+    try:
+      counts = self.__counts.items()
+    finally:
+      self.__lock.release()
+    counts.sort()
+    for (stack, count) in counts:
+      output.write('%s %d\n' % (';'.join(stack), count))
+
+  def __Label(self, code):
+    """Return the (cached) stack frame label for a code object."""
+    label = self.__labels.get(code)
+    if label is None:
+      label = self.__labels[code] = '%s (%s:%d)' % (
+          code.co_name, os.path.basename(code.co_filename),
+          code.co_firstlineno)
+    return label
+
+  def __Sample(self, frame):
+    """Return the tagged stack of a frame if it is handling a command.
+
+    Args:
+      frame: The innermost frame of a thread.
+
+    Returns:
+      A tuple of frame labels, outermost first, or None.
+    """
+    stack = []
+    while frame is not None:
+      code = frame.f_code
+      stack.append(self.__Label(code))
+      if code is _DISPATCH_CODE:
+        cmd = frame.f_locals.get('cmd')
+        stack.append('command:%s' % ppymilterbase.COMMANDS.get(cmd, cmd))
+        stack.append('stage:%s' % STAGES.get(cmd, 'unknown'))
+        stack.reverse()
+        return tuple(stack)
+      frame = frame.f_back
+    return None
+
+  def __Run(self, stop):
+    """Sampling loop run by the profiler thread."""
+    me = threading.currentThread().ident
+    while not stop.isSet():
+      (samples, frames) = ([], sys._current_frames())
+      for (ident, frame) in frames.iteritems():
+        if ident != me:
+          stack = self.__Sample(frame)
+          if stack is not None:
+            samples.append(stack)
+      frames = frame = None  # Do not keep the sampled frames alive.
+      if samples:
+        self.__lock.acquire()
+        try:
+          for stack in samples:
+            self.__counts[stack] = self.__counts.get(stack, 0) + 1
+        finally:
+          self.__lock.release()
+      stop.wait(self.interval)
+
+
+def InstallSignalHandler(profiler, path, signum=signal.SIGUSR1):
+  """Install a signal handler toggling a profiler on and off.
+
+  When the profiler is stopped by the signal, the samples collected are
+  written to path and discarded.
+
+  Args:
+    profiler: A SamplingProfiler.
+    path: The file to write the collapsed stacks to.
+    signum: The signal to toggle the profiler with.
+  """
+  def Toggle(signum, frame):
+    if not profiler.IsRunning():
+      profiler.Start()
+      return
+    profiler.Stop()
+    output = open(path, 'w')
+    try:
+      profiler.Write(output)
+    finally:
+      output.close()
+    profiler.Clear()
+    logger.info('Profile written to %s', path)
+  signal.signal(signum, Toggle)
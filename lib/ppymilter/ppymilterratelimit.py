@@ -0,0 +1,310 @@
+# $Id$
+# ==============================================================================
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+#
+# Rate limiting primitives for milters, e.g. to limit messages or recipients
+# per client address, sender or recipient.
+#
+# All structures use a fixed amount of memory regardless of the number of
+# distinct keys: keys are hashed into a fixed number of counters (in several
+# rows, count-min sketch style), which may overestimate counts when keys
+# collide but never underestimates them.  Every operation is O(depth).  They
+# are safe to share between threads (e.g. the ThreadedPpyMilterServer) and,
+# when constructed with shared=True before forking, between processes.
+#
+# Example usage:
+#"""
+#   import ppymilterbase
+#   import ppymilterratelimit
+#
+#   # At most 100 recipients per client address per hour, across all worker
+#   # processes forked after this.
+#   RCPTS_PER_CLIENT = ppymilterratelimit.SlidingWindowCounter(3600,
+#                                                              shared=True)
+#
+#   class RateLimitMilter(ppymilterbase.PpyMilter):
+#     def OnConnect(self, cmd, hostname, family, port, address):
+#       self.__address = address
+#       return self.Continue()
+#     def OnRcptTo(self, cmd, rcpt_to, esmtp_info):
+#       if RCPTS_PER_CLIENT.Hit(self.__address) > 100:
+#         return self.CustomReply(450, '4.7.1 Too many recipients')
+#       return self.Continue()
+#"""
+#
+
+import array
+import ctypes
+import mmap
+import multiprocessing
+import threading
+import time
+import zlib
+
+_CTYPES = {'I': ctypes.c_uint32, 'd': ctypes.c_double}
+_MAX_COUNT = 0xffffffff
+
+
+def _Array(typecode, size, shared):
+  """Allocate a zeroed array of counters.
+
+  Args:
+    typecode: 'I' for unsigned 32 bit integers, 'd' for doubles.
+    size: The number of elements.
+    shared: Whether to allocate the array in anonymous shared memory, which
+            processes forked afterwards share with this one.
+  """
+  if not shared:
+    return array.array(typecode, [0]) * size
+  ctype = _CTYPES[typecode]
+  return (ctype * size).from_buffer(mmap.mmap(-1, ctypes.sizeof(ctype) * size))
+
+
+def _Zero(counters, start, stop):
+  """Reset counters[start:stop] to 0."""
+  if isinstance(counters, array.array):
+    counters[start:stop] = array.array(counters.typecode, [0]) * (stop - start)
+  else:
+    size = ctypes.sizeof(counters) // len(counters)
+    ctypes.memset(ctypes.addressof(counters) + start * size, 0,
+                  (stop - start) * size)
+
+
+def _Lock(lock, shared):
+  """Return lock, or a new lock suitable for the sharing mode."""
+  if lock is not None:
+    return lock
+  if shared:
+    return multiprocessing.Lock()
+  return threading.Lock()
+
+
+def _Slots(key, width, depth):
+  """Return one counter index per row for a key.
+
+  Args:
+    key: A string.
+    width: The number of counters per row.
+    depth: The number of rows.
+  """
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  h1 = zlib.crc32(key) & 0xffffffff
+  h2 = (zlib.adler32(key) & 0xffffffff) | 1
+  return [row * width + (h1 + row * h2) % width for row in xrange(depth)]
+
+
+class CountMinSketch(object):
+  """Approximate counts of arbitrarily many keys in width * depth counters."""
+
+  def __init__(self, width=65536, depth=4, shared=False, lock=None):
+    """Constructs a CountMinSketch.
+
+    Args:
+      width: The number of counters per row.
+      depth: The number of rows (hash functions).
+      shared: Whether to keep the counters in memory shared with processes
+              forked afterwards.
+      lock: The lock to use; by default a threading.Lock, or a
+            multiprocessing.Lock if shared.
+    """
+    self.width = width
+    self.depth = depth
+    self.__counters = _Array('I', width * depth, shared)
+    self.__lock = _Lock(lock, shared)
+
+  def Add(self, key, count=1):
+    """Count a key and return its new estimated count."""
+    slots = _Slots(key, self.width, self.depth)
+    counters = self.__counters
+    self.__lock.acquire()
+    try:
+      # Conservative update: only raise the counters that are below the new
+      # estimate, which reduces overestimation due to collisions.
+      estimate = min(min([counters[i] for i in slots]) + count, _MAX_COUNT)
+      for i in slots:
+        if counters[i] < estimate:
+          counters[i] = estimate
+    finally:
+      self.__lock.release()
+    return estimate
+
+  def Estimate(self, key):
+    """Return the estimated count of a key."""
+    counters = self.__counters
+    return min([counters[i] for i in _Slots(key, self.width, self.depth)])
+
+  def Clear(self):
+    """Reset all counts to 0."""
+    self.__lock.acquire()
+    try:
+      _Zero(self.__counters, 0, len(self.__counters))
+    finally:
+      self.__lock.release()
+
+
+class SlidingWindowCounter(object):
+  """Approximate per-key event counts over a sliding time window.
+
+  Keeps count-min sketches for the current and the previous fixed window and
+  weights the previous window's count by how much of it the sliding window
+  still overlaps.
+  """
+
+  def __init__(self, window, width=65536, depth=4, shared=False, lock=None,
+               clock=time.time):
+    """Constructs a SlidingWindowCounter.
+
+    Args:
+      window: The length of the window in seconds.
+      width: The number of counters per row.
+      depth: The number of rows (hash functions).
+      shared: Whether to keep the counters in memory shared with processes
+              forked afterwards.
+      lock: The lock to use; by default a threading.Lock, or a
+            multiprocessing.Lock if shared.
+      clock: Function returning the current time in seconds.
+    """
+    self.window = float(window)
+    self.width = width
+    self.depth = depth
+    self.__table_size = width * depth
+    self.__counters = _Array('I', 2 * self.__table_size, shared)
+    # [start of the current window, offset of the current window's table]
+    self.__state = _Array('d', 2, shared)
+    self.__lock = _Lock(lock, shared)
+    self.__clock = clock
+    self.__state[0] = clock()
+
+  def __Advance(self, now):
+    """Start new windows as time passes (called with the lock held).
+
+    Returns:
+      A tuple (current, previous, weight) of the offsets of the current and
+      the previous window's tables and the weight of the previous window.
+    """
+    state = self.__state
+    size = self.__table_size
+    elapsed = now - state[0]
+    if elapsed >= self.window:
+      current = int(state[1])
+      if elapsed >= 2 * self.window:
+        _Zero(self.__counters, 0, 2 * size)
+      else:
+        current = size - current
+        _Zero(self.__counters, current, current + size)
+      state[1] = current
+      state[0] = now - elapsed % self.window
+      elapsed %= self.window
+    current = int(state[1])
+    return (current, size - current, 1.0 - elapsed / self.window)
+
+  def __Estimate(self, slots, current, previous, weight):
+    counters = self.__counters
+    return (min([counters[current + i] for i in slots]) +
+            weight * min([counters[previous + i] for i in slots]))
+
+  def Hit(self, key, count=1):
+    """Count an event for a key.
+
+    Returns:
+      The estimated number of events for the key within the last window,
+      including this one.
+    """
+    slots = _Slots(key, self.width, self.depth)
+    counters = self.__counters
+    self.__lock.acquire()
+    try:
+      (current, previous, weight) = self.__Advance(self.__clock())
+      value = min(min([counters[current + i] for i in slots]) + count,
+                  _MAX_COUNT)
+      for i in slots:
+        if counters[current + i] < value:
+          counters[current + i] = value
+      return self.__Estimate(slots, current, previous, weight)
+    finally:
+      self.__lock.release()
+
+  def Estimate(self, key):
+    """Return the estimated number of events for a key in the last window."""
+    slots = _Slots(key, self.width, self.depth)
+    self.__lock.acquire()
+    try:
+      return self.__Estimate(slots, *self.__Advance(self.__clock()))
+    finally:
+      self.__lock.release()
+
+
+class TokenBucket(object):
+  """Approximate per-key token buckets in a fixed number of hashed slots.
+
+  Each key maps to one bucket per row; colliding keys share buckets, and a
+  key may consume tokens if any of its buckets (i.e. the least contended one)
+  has enough.
+  """
+
+  def __init__(self, rate, burst, width=65536, depth=2, shared=False,
+               lock=None, clock=time.time):
+    """Constructs a TokenBucket.
+
+    Args:
+      rate: Tokens added to each bucket per second.
+      burst: Bucket capacity (and initial fill).
+      width: The number of buckets per row.
+      depth: The number of rows (hash functions).
+      shared: Whether to keep the buckets in memory shared with processes
+              forked afterwards.
+      lock: The lock to use; by default a threading.Lock, or a
+            multiprocessing.Lock if shared.
+      clock: Function returning the current time in seconds.
+    """
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.width = width
+    self.depth = depth
+    self.__tokens = _Array('d', width * depth, shared)
+    self.__stamps = _Array('d', width * depth, shared)
+    self.__lock = _Lock(lock, shared)
+    self.__clock = clock
+
+  def Consume(self, key, count=1):
+    """Try to take tokens from a key's bucket.
+
+    Returns:
+      True if the tokens were available (the action is allowed), False
+      otherwise.
+    """
+    slots = _Slots(key, self.width, self.depth)
+    (tokens, stamps) = (self.__tokens, self.__stamps)
+    self.__lock.acquire()
+    try:
+      now = self.__clock()
+      levels = []
+      for i in slots:
+        if stamps[i]:
+          levels.append(min(self.burst,
+                            tokens[i] + (now - stamps[i]) * self.rate))
+        else:
+          levels.append(self.burst)
+      allowed = max(levels) >= count
+      if allowed:
+        levels = [max(level - count, 0.0) for level in levels]
+      for (i, level) in zip(slots, levels):
+        tokens[i] = level
+        stamps[i] = now
+      return allowed
+    finally:
+      self.__lock.release()
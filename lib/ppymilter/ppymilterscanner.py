@@ -0,0 +1,418 @@
+# $Id$
+# ==============================================================================
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+#
+# Pooled streaming client for content scanner daemons speaking the clamd
+# protocol (IDSESSION/INSTREAM), plus a tiny fake scanner for tests.
+#
+# Body chunks are streamed to the scanner as the MTA sends them, over
+# persistent connections, and the verdict is collected at the end of the
+# message.  Calls block (on a local socket), so this is best used with the
+# ThreadedPpyMilterServer.
+#
+# Example usage:
+#"""
+#   import ppymilterbase
+#   import ppymilterscanner
+#   import ppymilterserver
+#
+#   class VirusMilter(ppymilterbase.PpyMilter):
+#     def __init__(self, scanner_pool):
+#       ppymilterbase.PpyMilter.__init__(self)
+#       self.__pool = scanner_pool
+#       self.__scan = None
+#     def OnBody(self, cmd, data):
+#       if self.__scan is None:
+#         self.__scan = self.__pool.StartScan()
+#       self.__scan.Feed(data)
+#       return self.Continue()
+#     def OnEndBody(self, cmd):
+#       (scan, self.__scan) = (self.__scan, None)
+#       if scan is not None and scan.Finish():
+#         return self.Reject()
+#       return self.Continue()
+#     def OnResetState(self):
+#       # Called on Abort, and via PpyMilter.OnResetConnection() when a pooled
+#       # instance's connection closes, possibly in the middle of a message.
+#       if self.__scan is not None:
+#         self.__scan.Abort()
+#         self.__scan = None
+#
+#   pool = ppymilterscanner.ScannerPool('/var/run/clamav/clamd.ctl')
+#   server = ppymilterserver.ThreadedPpyMilterServer(port, VirusMilter, pool)
+#   server.loop()
+#"""
+#
+
+import logging
+import os
+import socket
+import SocketServer
+import struct
+import threading
+import time
+
+import ppymilterbase
+
+logger = logging.getLogger('ppymilter')
+
+# The EICAR anti-virus test file, which FakeScanner reports by default.
+EICAR = (r'X5O!P%@AP[4\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!'
+         r'$H+H*')
+
+
+class ScannerError(ppymilterbase.PpyMilterTempFailure):
+  """Exception raised when the content scanner is unavailable or fails.
+
+  Unless caught by the milter, this causes the dispatcher to tempfail the
+  command.
+  """
+
+
+class _ScannerConnection(object):
+  """A persistent connection to a clamd-style scanner in IDSESSION mode."""
+
+  def __init__(self, sock_info, timeout):
+    """Connect to the scanner and start a session.
+
+    Args:
+      sock_info: A (sock_family, sock_addr) tuple.
+      timeout: Socket timeout in seconds.
+    """
+    (sock_family, sock_addr) = sock_info
+    self.__sock = socket.socket(sock_family, socket.SOCK_STREAM)
+    self.__sock.settimeout(timeout)
+    self.__sock.connect(sock_addr)
+    self.__buffer = ''
+    self.__next_id = 1
+    self.__sock.sendall('zIDSESSION\0')
+    self.last_used = time.time()
+
+  def __Reply(self):
+    """Read the reply to the oldest outstanding command."""
+    while '\0' not in self.__buffer:
+      data = self.__sock.recv(4096)
+      if not data:
+        raise socket.error('scanner closed the connection')
+      self.__buffer += data
+    (reply, self.__buffer) = self.__buffer.split('\0', 1)
+    (request_id, reply) = reply.split(': ', 1)
+    if int(request_id) != self.__next_id:
+      raise socket.error('reply out of sequence: %r' % reply)
+    self.__next_id += 1
+    self.last_used = time.time()
+    return reply
+
+  def Ping(self):
+    """Check that the scanner is still responsive."""
+    self.__sock.sendall('zPING\0')
+    return self.__Reply() == 'PONG'
+
+  def StartStream(self):
+    """Start scanning a stream of data."""
+    self.__sock.sendall('zINSTREAM\0')
+
+  def Write(self, chunk):
+    """Send a chunk of the stream being scanned."""
+    if chunk:
+      self.__sock.sendall(struct.pack('!I', len(chunk)) + chunk)
+
+  def EndStream(self):
+    """Finish the stream being scanned and return the scanner's reply."""
+    self.__sock.sendall(struct.pack('!I', 0))
+    return self.__Reply()
+
+  def Close(self):
+    """End the session and close the connection."""
+    try:
+      self.__sock.sendall('zEND\0')
+    except socket.error:
+      pass
+    self.__sock.close()
+
+
+class ScanSession(object):
+  """A single message being streamed to the scanner (see
+  ScannerPool.StartScan()).  Call Feed() for each body chunk, then either
+  Finish() to obtain the verdict or Abort() if the message is abandoned.
+
+  A session that is garbage collected without either (e.g. because the milter
+  connection was closed in the middle of a message) is aborted, so that its
+  pool slot is not lost.
+  """
+
+  def __init__(self, pool, connection):
+    self.__pool = pool
+    self.__connection = connection
+
+  def __del__(self):
+    if self.__connection is not None:
+      logger.warn('Aborting abandoned scan session')
+      self.Abort()
+
+  def __Fail(self, e):
+    """Discard the connection after an error and raise ScannerError."""
+    (connection, self.__connection) = (self.__connection, None)
+    self.__pool._Release(connection, False)
+    raise ScannerError('content scanner failed: %s' % e)
+
+  def Feed(self, chunk):
+    """Stream a chunk of the message to the scanner.
+
+    Raises:
+      ScannerError: The scanner connection failed.
+    """
+    try:
+      self.__connection.Write(chunk)
+    except socket.error, e:
+      self.__Fail(e)
+
+  def Finish(self):
+    """Finish the scan.
+
+    Returns:
+      The name of the signature found, or None if the message is clean.
+
+    Raises:
+      ScannerError: The scanner connection failed or the scanner reported an
+                    error (e.g. the stream exceeded its size limit).
+    """
+    try:
+      reply = self.__connection.EndStream()
+    except (socket.error, ValueError), e:
+      self.__Fail(e)
+    (connection, self.__connection) = (self.__connection, None)
+    self.__pool._Release(connection, True)
+    if reply.endswith(' OK'):
+      return None
+    if reply.endswith(' FOUND'):
+      return reply[reply.find(': ') + 2:-len(' FOUND')]
+    raise ScannerError('content scanner error: %s' % reply)
+
+  def Abort(self):
+    """Abandon the scan, e.g. because the MTA aborted the message."""
+    if self.__connection is not None:
+      (connection, self.__connection) = (self.__connection, None)
+      self.__pool._Release(connection, False)
+
+
+class ScannerPool(object):
+  """A bounded pool of persistent connections to a clamd-style scanner.
+
+  Safe to share between the connection threads of a ThreadedPpyMilterServer
+  (pass it as the server context).
+  """
+
+  def __init__(self, sock_info_or_path, max_connections=8, timeout=30,
+               health_check_interval=10):
+    """Constructs a ScannerPool.
+
+    Args:
+      sock_info_or_path: A (sock_family, sock_addr) tuple, or the path of the
+                         scanner's UNIX domain socket.
+      max_connections: Maximum number of concurrent scans (and connections).
+      timeout: Seconds to wait for a free connection, and socket timeout.
+      health_check_interval: Idle connections unused for longer than this
+                             many seconds are pinged before they are reused.
+    """
+    if isinstance(sock_info_or_path, tuple):
+      self.__sock_info = sock_info_or_path
+    else:
+      self.__sock_info = (socket.AF_UNIX, sock_info_or_path)
+    self.__max_connections = max_connections
+    self.__timeout = timeout
+    self.__health_check_interval = health_check_interval
+    self.__idle = []
+    self.__active = 0
+    self.__condition = threading.Condition()
+
+  def __Connection(self):
+    """Return a healthy connection, reusing an idle one if possible."""
+    while True:
+      self.__condition.acquire()
+      try:
+        if not self.__idle:
+          break
+        connection = self.__idle.pop()
+      finally:
+        self.__condition.release()
+      if time.time() - connection.last_used < self.__health_check_interval:
+        return connection
+      try:
+        if connection.Ping():
+          return connection
+      except (socket.error, ValueError):
+        pass
+      logger.info('Discarding unhealthy scanner connection')
+      connection.Close()
+    return _ScannerConnection(self.__sock_info, self.__timeout)
+
+  def StartScan(self):
+    """Start streaming a message to the scanner.
+
+    Returns:
+      A ScanSession.
+
+    Raises:
+      ScannerError: No connection became available within the timeout or the
+                    scanner could not be reached.
+    """
+    deadline = time.time() + self.__timeout
+    self.__condition.acquire()
+    try:
+      while self.__active >= self.__max_connections:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise ScannerError('too many concurrent scans')
+        self.__condition.wait(remaining)
+      self.__active += 1
+    finally:
+      self.__condition.release()
+    try:
+      connection = self.__Connection()
+      connection.StartStream()
+    except socket.error, e:
+      self._Release(None, False)
+      raise ScannerError('cannot reach content scanner: %s' % e)
+    return ScanSession(self, connection)
+
+  def _Release(self, connection, reusable):
+    """Return a connection to the pool (for use by ScanSession).
+
+    Args:
+      connection: The connection, or None.
+      reusable: Whether the connection may be used for another scan.
+    """
+    self.__condition.acquire()
+    try:
+      self.__active -= 1
+      if connection is not None and reusable:
+        self.__idle.append(connection)
+        connection = None
+      self.__condition.notify()
+    finally:
+      self.__condition.release()
+    if connection is not None:
+      connection.Close()
+
+  def Close(self):
+    """Close all idle connections."""
+    self.__condition.acquire()
+    try:
+      (idle, self.__idle) = (self.__idle, [])
+    finally:
+      self.__condition.release()
+    for connection in idle:
+      connection.Close()
+
+
+class FakeScanner(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """A tiny clamd stand-in listening on a UNIX domain socket, for tests.
+
+  Understands the PING, INSTREAM, IDSESSION and END commands ('z' prefixed)
+  and reports any stream containing one of its signatures as infected.
+  Counts the connections (connections) and scans (scans) it has served.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, path, signatures=None):
+    """Constructs a FakeScanner.
+
+    Args:
+      path: The path of the UNIX domain socket to listen on.
+      signatures: Dict mapping byte strings to the signature names to report
+                  for streams containing them.  Defaults to detecting EICAR.
+    """
+    if signatures is None:
+      signatures = {EICAR: 'Eicar-Test-Signature'}
+    self.signatures = signatures
+    self.connections = 0
+    self.scans = 0
+    SocketServer.UnixStreamServer.__init__(self, path,
+                                           FakeScanner.ConnectionHandler)
+
+  def Start(self):
+    """Serve requests in a background thread."""
+    thread = threading.Thread(target=self.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+  def Stop(self):
+    """Stop serving and remove the socket."""
+    self.shutdown()
+    self.server_close()
+    os.unlink(self.server_address)
+
+  def Scan(self, data):
+    """Return the reply for a scanned stream."""
+    self.scans += 1
+    for (signature, name) in self.signatures.iteritems():
+      if signature in data:
+        return 'stream: %s FOUND' % name
+    return 'stream: OK'
+
+  class ConnectionHandler(SocketServer.StreamRequestHandler):
+
+    def __Command(self):
+      """Read a 'z' prefixed, NUL terminated command."""
+      command = []
+      while True:
+        char = self.rfile.read(1)
+        if not char:
+          return None
+        if char == '\0':
+          return ''.join(command)[1:]
+        command.append(char)
+
+    def __Stream(self):
+      """Read an INSTREAM body, or return None if the client went away."""
+      chunks = []
+      while True:
+        length = self.rfile.read(4)
+        if len(length) < 4:
+          return None
+        length = struct.unpack('!I', length)[0]
+        if not length:
+          return ''.join(chunks)
+        chunks.append(self.rfile.read(length))
+
+    def handle(self):
+      self.server.connections += 1
+      (session, request_id) = (False, 0)
+      while True:
+        command = self.__Command()
+        if command is None or command == 'END':
+          return
+        if command == 'IDSESSION':
+          session = True
+          continue
+        if command == 'PING':
+          reply = 'PONG'
+        elif command == 'INSTREAM':
+          data = self.__Stream()
+          if data is None:
+            return
+          reply = self.server.Scan(data)
+        else:
+          reply = 'UNKNOWN COMMAND'
+        if session:
+          request_id += 1
+          reply = '%d: %s' % (request_id, reply)
+        self.wfile.write(reply + '\0')
+        self.wfile.flush()
+        if not session:
+          return
@@ -36,6 +36,11 @@
 #   # to run threaded server
 #   ppymilterserver.ThreadedPpyMilterServer(port, MyHandler)
 #   ppymilterserver.loop()
+#
+#   # to re-import MyHandler's module on SIGHUP and to hand the listening
+#   # socket over to a freshly started copy of this program on SIGUSR2
+#   # (either server)
+#   ppymilterserver.InstallSignalHandlers(server)
 #"""
 #
 
@@ -44,12 +49,17 @@ __author__ = 'Eric DeFriez'
 import asynchat
 import asyncore
 import binascii
+import imp
 import logging
 import os
+import select
+import signal
 import socket
 import SocketServer
 import struct
+import subprocess
 import sys
+import threading
 import time
 
 import ppymilterbase
@@ -58,6 +68,265 @@ logger = logging.getLogger('ppymilter')
 
 MILTER_LEN_BYTES = 4  # from sendmail's include/libmilter/mfdef.h
 
+# Environment variable through which a server passes its listening socket's
+# file descriptor on to its successor process (see HandOff()).
+LISTEN_FD_ENV = 'PPYMILTER_LISTEN_FD'
+
+# Environment variable through which a server passes the write end of a pipe
+# to its successor process, on which the successor reports that it is ready.
+READY_FD_ENV = 'PPYMILTER_READY_FD'
+
+# Seconds to wait for a successor process to become ready (see HandOff()).
+HANDOFF_TIMEOUT = 60
+
+
+def ReloadMilterClass(milter_class):
+  """Import a fresh copy of the module defining a milter class.
+
+  The module is executed anew in a new module object, which replaces the old
+  one in sys.modules.  The old module is left untouched, so existing
+  instances of the old class keep working with the old module's globals.
+  Module-level state (e.g. caches or clients created at import time) is not
+  carried over but created afresh by the new module; keep state that must
+  outlive a reload in the server's context instead.  Only the module
+  defining milter_class itself is re-imported, not any modules it imports in
+  turn.
+
+  Args:
+    milter_class: A class (not an instance) that handles callbacks for
+                  milter commands (e.g. a child of the PpyMilter class).
+
+  Returns:
+    The class of the same name from the freshly imported module.
+
+  Raises:
+    ImportError: The class is defined in the __main__ module, which cannot be
+                 re-imported, or its module cannot be imported.
+  """
+  name = milter_class.__module__
+  if name == '__main__':
+    raise ImportError('cannot reload %s defined in __main__' %
+                      milter_class.__name__)
+  (package, _, basename) = name.rpartition('.')
+  path = sys.modules[package].__path__ if package else None
+  imp.acquire_lock()
+  try:
+    (fp, pathname, description) = imp.find_module(basename, path)
+    old_module = sys.modules.pop(name)
+    try:
+      module = imp.load_module(name, fp, pathname, description)
+    except:
+      sys.modules[name] = old_module
+      raise
+    finally:
+      if fp is not None:
+        fp.close()
+  finally:
+    imp.release_lock()
+  if package:
+    setattr(sys.modules[package], basename, module)
+  # Python clears the globals of a module object when it is freed: keep the
+  # old module alive for as long as its class (and so any instance) is.
+  milter_class._ppymilter_module = old_module
+  return getattr(module, milter_class.__name__)
+
+
+def InstallSignalHandlers(server, reload_signal=signal.SIGHUP,
+                          handoff_signal=signal.SIGUSR2):
+  """Install signal handlers that reload the milter class of a server or hand
+  its listening socket over to a new process.
+
+  The handlers only request the work (see the servers' RequestReload() and
+  RequestHandOff()), which is done outside of any milter handler.
+
+  Args:
+    server: An AsyncPpyMilterServer or ThreadedPpyMilterServer.
+    reload_signal: Signal that triggers server.Reload(), or None.
+    handoff_signal: Signal that triggers server.HandOff(), or None.
+  """
+  if reload_signal is not None:
+    signal.signal(reload_signal, lambda signum, frame: server.RequestReload())
+  if handoff_signal is not None:
+    signal.signal(handoff_signal,
+                  lambda signum, frame: server.RequestHandOff())
+
+
+def _MilterPool(milter_class, context, pool_size):
+  """Return a PpyMilterPool of up to pool_size instances, or None if 0."""
+  if not pool_size:
+    return None
+  return ppymilterbase.PpyMilterPool(milter_class, context, max_idle=pool_size)
+
+
+def _SpawnSuccessor(listen_sock):
+  """Start a new instance of the running program, passing it listen_sock.
+
+  The new process is detached (double-forked) and inherits only the
+  listening socket, whose file descriptor it finds in LISTEN_FD_ENV, and the
+  write end of a pipe, found in READY_FD_ENV, on which its server reports
+  that it is ready (see _ReportReady()).
+
+  Args:
+    listen_sock: The bound and listening server socket.
+
+  Returns:
+    The read end of the pipe (see _SuccessorReady()).
+  """
+  fd = listen_sock.fileno()
+  (ready_r, ready_w) = os.pipe()
+  pid = os.fork()
+  if pid:
+    os.close(ready_w)
+    os.waitpid(pid, 0)
+    return ready_r
+  try:
+    os.close(ready_r)
+    if os.fork() == 0:
+      try:
+        (low, high) = sorted([fd, ready_w])
+        os.closerange(3, low)
+        os.closerange(low + 1, high)
+        os.closerange(high + 1, subprocess.MAXFD)
+        os.environ[LISTEN_FD_ENV] = str(fd)
+        os.environ[READY_FD_ENV] = str(ready_w)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+      except Exception, e:
+        os.write(ready_w, 'E%s: %s' % (e.__class__.__name__, e))
+  finally:
+    os._exit(0)
+
+
+def _ReportReady():
+  """Tell the predecessor process, if any, that this process is ready to
+  take over its listening socket."""
+  fd = os.environ.pop(READY_FD_ENV, None)
+  if fd is None:
+    return
+  fd = int(fd)
+  try:
+    os.write(fd, 'R')
+  except OSError, e:
+    # The predecessor gave up waiting and keeps listening alongside us.
+    logger.error('Cannot report readiness to predecessor: %s', e)
+  os.close(fd)
+
+
+def _SuccessorReady(report):
+  """Check what a successor process reported on its readiness pipe.
+
+  Args:
+    report: The data read from the pipe ('' if the successor closed it).
+
+  Returns:
+    True if the successor is ready, False (after logging why) otherwise.
+  """
+  if report[:1] == 'R':
+    return True
+  if report[:1] == 'E':
+    logger.error('Hand-off failed, cannot start successor (%s); '
+                 'continuing to serve', report[1:])
+  else:
+    logger.error('Hand-off failed, successor exited before becoming ready; '
+                 'continuing to serve')
+  return False
+
+
+def _InheritedListenSocket(sock_family, sock_type=socket.SOCK_STREAM):
+  """Return the listening socket passed on by a predecessor process, if any.
+
+  Args:
+    sock_family: The address family of the socket.
+    sock_type: The type of the socket.
+
+  Returns:
+    A socket object, or None if this process did not inherit a socket.
+  """
+  fd = os.environ.pop(LISTEN_FD_ENV, None)
+  if fd is None:
+    return None
+  fd = int(fd)
+  sock = socket.fromfd(fd, sock_family, sock_type)
+  os.close(fd)
+  logger.info('Inherited listening socket %s', sock.getsockname())
+  return sock
+
+
+class ConnectionState(object):
+  """Live state of a milter connection, kept by the connection handlers for
+  inspection through the admin socket (see ppymilteradmin).
+
+  Attributes:
+    peer: The MTA's address.
+    thread: The ident of the thread handling the connection.
+    command: The command code of the command being or last handled.
+    stage: The SMTP stage of that command (see ppymilterbase.STAGES).
+    stage_since: When the connection entered that stage.
+    handler_since: When the handler for the current command was invoked, or
+                   None if no command is being handled.
+  """
+
+  __slots__ = ('peer', 'thread', 'command', 'stage', 'stage_since',
+               'handler_since')
+
+  def __init__(self, peer):
+    self.peer = peer
+    self.thread = threading.currentThread().ident
+    self.command = None
+    self.stage = None
+    self.stage_since = time.time()
+    self.handler_since = None
+
+  def Enter(self, cmd):
+    """Record that the handler for a command is being invoked."""
+    now = time.time()
+    stage = ppymilterbase.STAGES.get(cmd)
+    if stage != self.stage:
+      (self.stage, self.stage_since) = (stage, now)
+    self.command = cmd
+    self.handler_since = now
+
+  def Leave(self):
+    """Record that the handler for the current command has returned."""
+    self.handler_since = None
+
+
+class _SuccessorWatcher(asyncore.file_dispatcher):
+  """Waits on the readiness pipe of a successor process (see
+  AsyncPpyMilterServer.HandOff()) within the asyncore loop and closes the
+  server's listening socket once the successor is ready."""
+
+  def __init__(self, ready_fd, server, timeout, map=None):
+    asyncore.file_dispatcher.__init__(self, ready_fd, map)
+    os.close(ready_fd)  # file_dispatcher works on a duplicate.
+    self.__server = server
+    self.__timeout = timeout
+    self.__deadline = time.time() + timeout
+
+  def readable(self):
+    # Called on every iteration of the asyncore loop.
+    if time.time() > self.__deadline:
+      logger.error('Hand-off failed, successor not ready within %ss; '
+                   'continuing to serve', self.__timeout)
+      self.close()
+      return False
+    return True
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      report = os.read(self.socket.fd, 4096)
+    except OSError:
+      report = ''
+    self.close()
+    if _SuccessorReady(report):
+      logger.info('Handed off listening socket, finishing open connections')
+      self.__server.close()
+
+  def handle_close(self):
+    self.handle_read()
+
 
 class AsyncPpyMilterServer(asyncore.dispatcher):
   """Asynchronous server that handles connections from
@@ -65,7 +334,7 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
   """
 
   # TODO: allow network socket interface to be overridden
-  def __init__(self, sock_info_or_port, milter_class, max_queued_connections=1024, map=None, context=None):
+  def __init__(self, sock_info_or_port, milter_class, max_queued_connections=1024, map=None, context=None, pool_size=0):
     """Constructs an AsyncPpyMilterServer.
 
     Args:
@@ -75,11 +344,19 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
                     milter commands (e.g. a child of the PpyMilter class).
       max_queued_connections: Maximum number of connections to allow to
                               queue up on socket awaiting accept().
+      pool_size: If not 0, reuse milter_class instances across connections,
+                 keeping up to this many idle ones (see
+                 ppymilterbase.PpyMilterPool).
     """
     self.map     = map
     self.context = context
     asyncore.dispatcher.__init__(self, map=self.map)
     self.__milter_class = milter_class
+    self.__pool_size = pool_size
+    self.__pool = _MilterPool(milter_class, context, pool_size)
+    self.__connections = set()
+    self.__reload_requested = False
+    self.__handoff_requested = False
     sock_family = socket.AF_INET
     sock_type   = socket.SOCK_STREAM
     if isinstance(sock_info_or_port, tuple):
@@ -88,10 +365,17 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
     else:
         # Assume TCP port:
         sock_addr = ('', sock_info_or_port)
-    self.create_socket(sock_family, sock_type)
-    self.set_reuse_addr()
-    self.bind(sock_addr)
-    self.listen(max_queued_connections)
+    sock = _InheritedListenSocket(sock_family, sock_type)
+    if sock is not None:
+      sock.setblocking(0)
+      self.set_socket(sock)
+      self.accepting = True
+    else:
+      self.create_socket(sock_family, sock_type)
+      self.set_reuse_addr()
+      self.bind(sock_addr)
+      self.listen(max_queued_connections)
+    _ReportReady()
 
   def handle_accept(self):
     """Callback function from asyncore to handle a connection dispatching."""
@@ -104,11 +388,78 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
       logger.error('warning: server accept() threw an exception ("%s")',
                         str(e))
       return
-    AsyncPpyMilterServer.ConnectionHandler(conn, addr, self.__milter_class, self.map, self.handle_error, self.context)
+    AsyncPpyMilterServer.ConnectionHandler(conn, addr, self.__milter_class, self.map, self.handle_error, self.context, self.__pool, self.__connections)
 
   def handle_error(self):
     return False
 
+  def readable(self):
+    # Called on every iteration of the asyncore loop, in between the handling
+    # of socket events (and right after a signal interrupted the loop's
+    # select()): do the work requested by signal handlers here.
+    if self.__reload_requested:
+      self.__reload_requested = False
+      self.Reload()
+    if self.__handoff_requested:
+      self.__handoff_requested = False
+      try:
+        self.HandOff()
+      except Exception:
+        logger.exception('Hand-off failed; continuing to serve')
+    return asyncore.dispatcher.readable(self)
+
+  def Connections(self):
+    """Return the handlers of the currently open milter connections."""
+    return list(self.__connections)
+
+  def Reload(self):
+    """Re-import the milter class's module (see ReloadMilterClass()).
+
+    New connections are handled by the reloaded class while existing
+    connections finish with the instances they already have.
+
+    Returns:
+      True if the milter class was reloaded, False otherwise.
+    """
+    try:
+      self.__milter_class = ReloadMilterClass(self.__milter_class)
+    except Exception:
+      logger.exception('Failed to reload %s', self.__milter_class.__name__)
+      return False
+    self.__pool = _MilterPool(self.__milter_class, self.context,
+                              self.__pool_size)
+    logger.info('Reloaded %s', self.__milter_class.__name__)
+    return True
+
+  def HandOff(self, timeout=HANDOFF_TIMEOUT):
+    """Hand the listening socket over to a new instance of this program.
+
+    Once the new process reports that its server is ready, it accepts all
+    new connections and this server stops listening, so asyncore.loop()
+    returns once the connections already established have been closed.  If
+    the new process fails to start or does not become ready within timeout
+    seconds, this server keeps listening.
+    """
+    ready_fd = _SpawnSuccessor(self.socket)
+    logger.info('Started successor, waiting for it to become ready')
+    _SuccessorWatcher(ready_fd, self, timeout, self.map)
+
+  def RequestReload(self):
+    """Have the asyncore loop call Reload() on its next iteration.
+
+    Safe to call from a signal handler, which may have interrupted a milter
+    handler.
+    """
+    self.__reload_requested = True
+
+  def RequestHandOff(self):
+    """Have the asyncore loop call HandOff() on its next iteration.
+
+    Safe to call from a signal handler, which may have interrupted a milter
+    handler.
+    """
+    self.__handoff_requested = True
+
   class ConnectionHandler(asynchat.async_chat):
     """A connection handling class that manages communication on a
     specific connection's network socket.  Receives callbacks from asynchat
@@ -116,8 +467,12 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
     ready invokes the milter dispatching class.
     """
 
+    # Read from the socket in larger pieces than asynchat's default 4KB, as
+    # body chunks may be up to 1MB (see ppymilterbase.MILTER_MDS_1M).
+    ac_in_buffer_size = 65536
+
     # TODO: allow milter dispatcher to be overridden (PpyMilterDispatcher)?
-    def __init__(self, conn, addr, milter_class, map=None, on_error=None, context=None):
+    def __init__(self, conn, addr, milter_class, map=None, on_error=None, context=None, pool=None, connections=None):
       """A connection handling class to manage communication on this socket.
 
       Args:
@@ -125,14 +480,35 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
         addr: The address (port/ip) as returned by socket.accept()
         milter_class: A class (not an instance) that handles callbacks for
                       milter commands (e.g. a child of the PpyMilter class).
+        pool: An optional ppymilterbase.PpyMilterPool of milter_class
+              instances.
+        connections: An optional set to register this handler in while the
+                     connection is open.
       """
       asynchat.async_chat.__init__(self, conn, map)
       self.__conn = conn
       self.__addr = addr
-      self.__milter_dispatcher = ppymilterbase.PpyMilterDispatcher(milter_class, on_error, context)
+      self.__milter_dispatcher = ppymilterbase.PpyMilterDispatcher(milter_class, on_error, context, pool)
       self.__input = []
+      self.__packetlen = 0
+      self.__cmd = None
+      self.__connections = connections
+      self.state = ConnectionState(addr)
       self.set_terminator(MILTER_LEN_BYTES)
       self.found_terminator = self.read_packetlen
+      if connections is not None:
+        connections.add(self)
+
+    def close(self):
+      """Close the socket and release the milter instance."""
+      asynchat.async_chat.close(self)
+      self.__milter_dispatcher.Close()
+      if self.__connections is not None:
+        self.__connections.discard(self)
+
+    def Buffered(self):
+      """Return the number of bytes received but not yet dispatched."""
+      return len(self.ac_in_buffer) + sum([len(data) for data in self.__input])
 
     def collect_incoming_data(self, data):
       """Callback from asynchat--simply buffer partial data in a string."""
@@ -150,15 +526,44 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
       input buffer (the milter packet length)."""
       packetlen = int(struct.unpack('!I', "".join(self.__input))[0])
       self.__input = []
-      self.set_terminator(packetlen)
+      if not packetlen:
+        logger.error('Empty milter packet, closing connection')
+        self.close()
+        return
+      if packetlen > self.__milter_dispatcher.MaxDataSize() + 1:
+        logger.error('Milter packet too large (%d bytes), closing connection',
+                     packetlen)
+        self.close()
+        return
+      self.__packetlen = packetlen
+      self.set_terminator(1)
+      self.found_terminator = self.read_command
+
+    def read_command(self):
+      """Callback from asynchat once we have read the milter command code.
+      The command data is read separately, so that it can be passed to the
+      dispatcher without copying it again."""
+      self.__cmd = "".join(self.__input)
+      self.__input = []
+      if self.__packetlen == 1:
+        # No command data follows (and asynchat never completes a terminator
+        # of 0 bytes).
+        self.read_milter_data()
+        return
+      self.set_terminator(self.__packetlen - 1)
       self.found_terminator = self.read_milter_data
 
     def __send_response(self, response):
       """Send data down the milter socket.
 
       Args:
-        response: The data to send.
+        response: The data to send, or a producer of complete reply packets
+                  (e.g. a ppymilterbase.PpyMilterBodyReplacement).
       """
+      if hasattr(response, 'more'):
+        logger.debug('  >>> (producer) %r', response)
+        self.push_with_producer(response)
+        return
       logger.debug('  >>> %s', binascii.b2a_qp(response[0]))
       self.push(struct.pack('!I', len(response)))
       self.push(response)
@@ -166,12 +571,17 @@ class AsyncPpyMilterServer(asyncore.dispatcher):
     def read_milter_data(self):
       """Callback from asynchat once we have read the milter packet length
       worth of bytes on the socket and it is accumulated in our input buffer
-      (which is the milter command + data to send to the dispatcher)."""
-      inbuff = "".join(self.__input)
+      (which is the milter command data to send to the dispatcher)."""
+      (cmd, inbuff) = (self.__cmd, "".join(self.__input))
       self.__input = []
-      logger.debug('  <<< %s', binascii.b2a_qp(inbuff))
+      if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('  <<< %s', binascii.b2a_qp(cmd + inbuff))
       try:
-        response = self.__milter_dispatcher.Dispatch(inbuff)
+        self.state.Enter(cmd)
+        try:
+          response = self.__milter_dispatcher.Dispatch(inbuff, cmd)
+        finally:
+          self.state.Leave()
         if type(response) == list:
           for r in response:
             self.__send_response(r)
@@ -190,48 +600,184 @@ class ThreadedPpyMilterServer(SocketServer.ThreadingTCPServer):
 
   allow_reuse_address = True
 
-  def __init__(self, port, milter_class, context=None):
+  def __init__(self, port, milter_class, context=None, pool_size=0):
     SocketServer.ThreadingTCPServer.__init__(self, ('', port),
-                                    ThreadedPpyMilterServer.ConnectionHandler)
+                                    ThreadedPpyMilterServer.ConnectionHandler,
+                                    bind_and_activate=False)
+    sock = _InheritedListenSocket(self.address_family, self.socket_type)
+    if sock is not None:
+      self.socket.close()
+      self.socket = sock
+      self.server_address = sock.getsockname()
+    else:
+      try:
+        self.server_bind()
+        self.server_activate()
+      except Exception:
+        self.server_close()
+        raise
     self.milter_class = milter_class
     self.context = context
+    self.pool_size = pool_size
+    self.pool = _MilterPool(milter_class, context, pool_size)
+    self.connections = set()
     self.loop = self.serve_forever
+    _ReportReady()
 
   def handle_error(self):
     return False
 
+  def Connections(self):
+    """Return the handlers of the currently open milter connections."""
+    return list(self.connections)
+
+  def Reload(self):
+    """Re-import the milter class's module (see ReloadMilterClass()).
+
+    New connections are handled by the reloaded class while existing
+    connections finish with the instances they already have.
+
+    Returns:
+      True if the milter class was reloaded, False otherwise.
+    """
+    try:
+      self.milter_class = ReloadMilterClass(self.milter_class)
+    except Exception:
+      logger.exception('Failed to reload %s', self.milter_class.__name__)
+      return False
+    self.pool = _MilterPool(self.milter_class, self.context, self.pool_size)
+    logger.info('Reloaded %s', self.milter_class.__name__)
+    return True
+
+  def HandOff(self, timeout=HANDOFF_TIMEOUT):
+    """Hand the listening socket over to a new instance of this program.
+
+    Once the new process reports that its server is ready, it accepts all
+    new connections and this server stops listening, so loop() returns; the
+    process exits once the connection threads already running have finished.
+    If the new process fails to start or does not become ready within
+    timeout seconds, this server keeps listening.
+    """
+    ready_fd = _SpawnSuccessor(self.socket)
+    logger.info('Started successor, waiting for it to become ready')
+    # Wait in a separate thread: we may be running in a signal handler on
+    # top of serve_forever(), which shutdown() waits for to return.
+    def AwaitSuccessor():
+      try:
+        if not select.select([ready_fd], [], [], timeout)[0]:
+          logger.error('Hand-off failed, successor not ready within %ss; '
+                       'continuing to serve', timeout)
+          return
+        if not _SuccessorReady(os.read(ready_fd, 4096)):
+          return
+      finally:
+        os.close(ready_fd)
+      logger.info('Handed off listening socket, finishing open connections')
+      self.shutdown()
+      self.server_close()
+    threading.Thread(target=AwaitSuccessor).start()
+
+  def RequestReload(self):
+    """Call Reload() in a separate thread.
+
+    Safe to call from a signal handler: milter handlers run in threads of
+    their own, and the reload leaves the module they use untouched.
+    """
+    threading.Thread(target=self.Reload).start()
+
+  def RequestHandOff(self):
+    """Call HandOff(), which waits for the successor in a separate thread.
+
+    Safe to call from a signal handler.
+    """
+    self.HandOff()
+
 
   class ConnectionHandler(SocketServer.BaseRequestHandler):
     def setup(self):
       self.request.setblocking(True)
       self.__milter_dispatcher = ppymilterbase.PpyMilterDispatcher(
-          self.server.milter_class, self.server.handle_error, self.server.context)
+          self.server.milter_class, self.server.handle_error, self.server.context,
+          self.server.pool)
+      self.__buffered = 0
+      self.state = ConnectionState(self.client_address)
+      self.server.connections.add(self)
+
+    def finish(self):
+      self.server.connections.discard(self)
+      self.__milter_dispatcher.Close()
+
+    def Buffered(self):
+      """Return the number of bytes received but not yet dispatched."""
+      return self.__buffered
 
     def __send_response(self, response):
       """Send data down the milter socket.
 
       Args:
-        response: the data to send
+        response: the data to send, or a producer of complete reply packets
+                  (e.g. a ppymilterbase.PpyMilterBodyReplacement)
       """
+      if hasattr(response, 'more'):
+        logger.debug('  >>> (producer) %r', response)
+        packet = response.more()
+        while packet:
+          self.request.sendall(packet)
+          packet = response.more()
+        return
       logger.debug('  >>> %s', binascii.b2a_qp(response[0]))
       self.request.send(struct.pack('!I', len(response)))
       self.request.send(response)
 
+    def __receive(self, size):
+      """Read exactly size bytes from the milter socket.
+
+      Reads into a single preallocated buffer, so large packets (body chunks
+      may be up to 1MB) are not assembled from many partial strings.
+
+      Returns:
+        The data, or None if the MTA closed the connection.
+      """
+      data = bytearray(size)
+      view = memoryview(data)
+      read = 0
+      while read < size:
+        received = self.request.recv_into(view[read:], size - read)
+        if not received:
+          return None
+        read += received
+        self.__buffered = read
+      self.__buffered = 0
+      return str(data)
+
     def handle(self):
       try:
         while True:
-          packetlen = int(struct.unpack('!I',
-                                        self.request.recv(MILTER_LEN_BYTES))[0])
-          inbuf = []
-          read = 0
-          while read < packetlen:
-            partial_data = self.request.recv(packetlen - read)
-            inbuf.append(partial_data)
-            read += len(partial_data)
-          data = "".join(inbuf)
-          logger.debug('  <<< %s', binascii.b2a_qp(data))
+          data = self.__receive(MILTER_LEN_BYTES)
+          if data is None:
+            break
+          packetlen = int(struct.unpack('!I', data)[0])
+          if not packetlen:
+            logger.error('Empty milter packet, closing connection')
+            break
+          if packetlen > self.__milter_dispatcher.MaxDataSize() + 1:
+            logger.error('Milter packet too large (%d bytes), closing '
+                         'connection', packetlen)
+            break
+          # Read the command code separately, so that the command data can
+          # be passed to the dispatcher without copying it again.
+          cmd = self.__receive(1)
+          data = self.__receive(packetlen - 1)
+          if cmd is None or data is None:
+            break
+          if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('  <<< %s', binascii.b2a_qp(cmd + data))
           try:
-            response = self.__milter_dispatcher.Dispatch(data)
+            self.state.Enter(cmd)
+            try:
+              response = self.__milter_dispatcher.Dispatch(data, cmd)
+            finally:
+              self.state.Leave()
             if type(response) == list:
               for r in response:
                 self.__send_response(r)
@@ -260,6 +806,7 @@ if __name__ == '__main__':
                       datefmt='%Y-%m-%d@%H:%M:%S')
 
   server = AsyncPpyMilterServer(port, ppymilterbase.PpyMilter)
+  InstallSignalHandlers(server)
   asyncore.loop()
 
   #server = ThreadedPpyMilterServer(port, ppymilterbase.PpyMilter)
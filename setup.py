@@ -25,4 +25,5 @@ setup(name='ppymilter',
       url='https://github.com/jmehnle/ppymilter',
       package_dir={'': 'lib'},
       packages=['ppymilter'],
-      scripts=['lib/ppymilter/ppymilterserver.py'])
+      scripts=['lib/ppymilter/ppymilterserver.py',
+               'lib/ppymilter/ppymilterlookup.py'])